@@ -1,6 +1,9 @@
+import copy
 import logging
 import math
 import os
+import time
+import warnings
 import numpy as np
 import torch
 import torch.nn as nn
@@ -8,16 +11,41 @@ import torch.nn.functional as F
 import torch.optim as optim
 from tqdm import tqdm
 from collections import deque
-from random import shuffle
 import wandb
 import yaml
 
 import game
+import inference
+import metrics
+import replay
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 
+class MCTSNode:
+    """
+    Search statistics of one state, stored as contiguous arrays indexed by
+    action so that selection is a single vectorized argmax.
+    """
+
+    __slots__ = ("P", "V", "N", "W", "valids", "mask", "Ns", "children")
+
+    def __init__(self, P, valids, V=0.0):
+        self.P = P  # initial policy (returned by neural net)
+        self.V = V  # value of board s returned by neural net
+        self.N = np.zeros(len(P))  # #times edge s,a was visited
+        self.W = np.zeros(len(P))  # total value of edge s,a
+        self.valids = valids.astype(bool)  # game.getValidMoves for board s
+        self.mask = np.where(self.valids, 0.0, -np.inf)  # added to the bounds of invalid moves
+        self.Ns = 0  # #times board s was visited
+        self.children = {}  # action a -> board s' it leads to, once visited
+
+    def Q(self):
+        # W is 0 wherever N is 0, so unvisited edges get Q = 0
+        return self.W / np.maximum(self.N, 1)
+
+
 class MCTS:
     """
     This class handles the MCTS tree.
@@ -27,122 +55,429 @@ class MCTS:
         self.game = game
         self.nnet = nnet
         self.args = args
-        self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
-
+        self.nodes = {}  # stores the MCTSNode of every expanded board s
         self.Es = {}  # stores game.getGameEnded for board s
-        self.Vs = {}  # stores game.getValidMoves for board s
-
-    def getActionProb(self, canonicalBoard, temp=1):
+        # board s is keyed by its 64-bit Zobrist key, updated in O(1) per move
+        self.check_keys = args.get("zobrist_check", False)
+        self.cpuct = args.cpuct  # read once, args lookups are slow in select
+        self.boards = {}  # stores stringRepresentation for key s, only with check_keys
+
+        # counters for SelfPlay's metrics, plain ints so they cost next to nothing
+        self.num_sims = 0
+        self.num_expanded = 0  # leaves expanded
+        self.num_terminal = 0  # simulations ending in a terminal state
+        self.num_nn_calls = 0  # predict / predict_batch calls
+        self.num_nn_positions = 0  # boards evaluated by the network
+        self.max_depth = 0  # longest path of a simulation
+        self.max_tree_size = 0  # most nodes held after a getActionProb
+
+    def getActionProb(self, canonicalBoard, temp=1, num_sims=None):
         """
         This function performs numMCTSSims simulations of MCTS starting from
-        canonicalBoard.
+        canonicalBoard, or num_sims if given.
+
+        With search_mode "gumbel" the root search is gumbelSearch instead,
+        see there for the policy it returns.
 
         Returns:
             probs: a policy vector where the probability of the ith action is
-                   proportional to Nsa[(s,a)]**(1./temp)
+                   proportional to N(s,a)**(1./temp)
         """
-        for _ in range(self.args.numMCTSSims):
-            self.search(canonicalBoard)
+        keys = self.game.getZobristKeys(canonicalBoard)
+        s = keys[0]
+        if self.args.get("mcts_prune", False):
+            self.prune(s)
+        max_nodes = self.args.get("mcts_max_nodes", 0)
+
+        # every simulation plays its moves on this one board and takes them back
+        board = self.game.copyBoard(canonicalBoard)
+        if self.args.get("search_mode", "puct") == "gumbel":
+            return self.gumbelSearch(board, keys, temp, num_sims)
+
+        num_sims = num_sims or self.args.numMCTSSims
+        batch_size = self.args.get("mcts_batch_size", 1)
+        if batch_size > 1:
+            sims = 0
+            while sims < num_sims:
+                sims += self.searchBatch(
+                    board, min(batch_size, num_sims - sims), keys
+                )
+                if max_nodes and len(self.nodes) > max_nodes:
+                    self.evict(max_nodes, s)
+        else:
+            for _ in range(num_sims):
+                self.search(board, keys)
+                if max_nodes and len(self.nodes) > max_nodes:
+                    self.evict(max_nodes, s)
 
-        s = self.game.stringRepresentation(canonicalBoard)
-        counts = [
-            self.Nsa[(s, a)] if (s, a) in self.Nsa else 0
-            for a in range(self.game.getActionSize())
-        ]
+        self.num_sims += num_sims
+        self.max_tree_size = max(self.max_tree_size, len(self.nodes))
+
+        if s in self.nodes:
+            counts = self.nodes[s].N
+        else:
+            counts = np.zeros(self.game.getActionSize())
 
         if temp == 0:
-            bestAs = np.array(np.argwhere(counts == np.max(counts))).flatten()
+            bestAs = np.flatnonzero(counts == np.max(counts))
             bestA = np.random.choice(bestAs)
-            probs = [0] * len(counts)
+            probs = np.zeros(len(counts))
             probs[bestA] = 1
             return probs
 
-        counts = [x ** (1.0 / temp) for x in counts]
-        counts_sum = float(sum(counts))
-        probs = [x / counts_sum for x in counts]
-        return probs
+        counts = counts ** (1.0 / temp)
+        return counts / counts.sum()
+
+    def gumbelSearch(self, board, keys, temp=1, num_sims=None):
+        """
+        Root search by Gumbel-top-k sampling and sequential halving (Danihelka
+        et al., "Policy improvement by planning with Gumbel", 2022), for small
+        numMCTSSims. Below the root, simulations select by PUCT as usual.
+
+        The root's network logits, perturbed by Gumbel noise unless temp is 0,
+        pick gumbel_num_actions candidates. The num_sims simulations are
+        then split over ceil(log2(candidates)) phases: every phase gives the
+        remaining candidates an equal share of visits and keeps the better
+        half by logits + noise + sigma(Q). Once a share would be less than a
+        visit each, the leftover simulations go to the best ranked candidates
+        and the halving stops, so the search, root expansion included, never
+        runs more than num_sims simulations. The best remaining candidate is
+        the move to play, left in self.selected_action.
+
+        Returns:
+            probs: with temp 0 the survivor as a one-hot vector, otherwise
+                   the improved policy softmax(logits + sigma(completed Q)),
+                   where unvisited actions get the network's value estimate.
+        """
+        s = keys[0]
+        max_nodes = self.args.get("mcts_max_nodes", 0)
+        budget = num_sims or self.args.numMCTSSims
+        if s not in self.nodes:
+            self.search(board, keys)
+            self.num_sims += 1
+            budget -= 1
+        node = self.nodes[s]
+
+        valid = np.flatnonzero(node.valids)
+        logits = np.full(len(node.P), -np.inf)
+        logits[valid] = np.log(np.maximum(node.P[valid], 1e-12))
+        g = np.random.gumbel(size=len(logits)) if temp else np.zeros(len(logits))
+        m = min(self.args.get("gumbel_num_actions", 64), len(valid), max(budget, 1))
+        remaining = valid[np.argsort(-(g + logits)[valid], kind="stable")[:m]]
+
+        phases = max(1, math.ceil(math.log2(m)))
+        for phase in range(phases):
+            if budget <= 0:
+                break
+            # remaining is ordered best first, so a short budget goes to the best
+            visits = budget // ((phases - phase) * len(remaining))
+            searched = remaining if visits else remaining[:budget]
+            for a in searched:
+                for _ in range(max(visits, 1)):
+                    self.search(board, keys, root_action=a)
+                    if max_nodes and len(self.nodes) > max_nodes:
+                        self.evict(max_nodes, s)
+            budget -= max(visits, 1) * len(searched)
+            self.num_sims += max(visits, 1) * len(searched)
+            if len(remaining) > 1:
+                score = (g + logits + self._sigma(node, (node.Q() + 1) / 2))[remaining]
+                remaining = remaining[np.argsort(-score, kind="stable")[: (len(remaining) + 1) // 2]]
+        # simulations left over by the rounding of the shares go to the best candidate
+        for _ in range(max(budget, 0)):
+            self.search(board, keys, root_action=remaining[0])
+        self.num_sims += max(budget, 0)
+        score = (g + logits + self._sigma(node, (node.Q() + 1) / 2))[remaining]
+        self.selected_action = int(remaining[np.argmax(score)])
+        self.max_tree_size = max(self.max_tree_size, len(self.nodes))
+
+        if temp == 0:
+            probs = np.zeros(len(logits))
+            probs[self.selected_action] = 1
+            return probs
+
+        z = logits + self._sigma(node, self._completedQ(node))
+        probs = np.exp(z - z.max())
+        return probs / probs.sum()
+
+    def _sigma(self, node, q):
+        """Monotone transform of Q values in [0, 1], scaled up as the root's visits grow"""
+        c_visit = self.args.get("gumbel_c_visit", 50)
+        c_scale = self.args.get("gumbel_c_scale", 1.0)
+        return (c_visit + node.N.max()) * c_scale * q
 
-    def search(self, canonicalBoard):
+    def _completedQ(self, node):
         """
-        This function performs one iteration of MCTS. It is recursively called
+        Q values of node in [0, 1], where unvisited actions get v_mix, the
+        network value mixed with the prior-weighted Q of the visited ones.
+        """
+        q = (node.Q() + 1) / 2
+        visited = node.N > 0
+        sum_n = node.N.sum()
+        v_mix = (node.V + 1) / 2
+        p_visited = node.P[visited].sum()
+        if sum_n > 0 and p_visited > 0:
+            mixed = sum_n * (node.P[visited] * q[visited]).sum() / p_visited
+            v_mix = (v_mix + mixed) / (1 + sum_n)
+        return np.where(visited, q, v_mix)
+
+    def stats(self):
+        """The counters of every search run so far"""
+        return {
+            "mcts_sims": self.num_sims,
+            "mcts_expanded": self.num_expanded,
+            "mcts_terminal": self.num_terminal,
+            "mcts_nn_calls": self.num_nn_calls,
+            "mcts_nn_positions": self.num_nn_positions,
+            "mcts_max_depth": self.max_depth,
+            "mcts_max_tree_size": self.max_tree_size,
+        }
+
+    def search(self, canonicalBoard, keys=None, root_action=None):
+        """
+        This function performs one iteration of MCTS. It descends the tree
         till a leaf node is found. The action chosen at each node is one that
         has the maximum upper confidence bound as in the paper.
 
         Once a leaf node is found, the neural network is called to return an
         initial policy P and a value v for the state. This value is propagated
         up the search path. In case the leaf node is a terminal state, the
-        outcome is propagated up the search path. The values of Ns, Nsa, Qsa are
-        updated.
+        outcome is propagated up the search path. The N, W and Ns statistics
+        of the nodes on the path are updated.
 
         NOTE: Since v is in [-1,1] and if v is the value of a
         state for the current player, then its value is -v for the other player.
 
+        The moves of the descent are played on canonicalBoard in place and
+        taken back before returning, so no board is allocated per level.
+        keys are the game.getZobristKeys of canonicalBoard if the caller
+        already has them. If root_action is given, the simulation takes it
+        at the root instead of selecting one.
+
         Returns:
             v: the value of the current canonicalBoard
         """
-
-        s = self.game.stringRepresentation(canonicalBoard)
-
-        if s not in self.Es:
-            self.Es[s] = self.game.getGameEnded(canonicalBoard, 1)
-        if self.Es[s] is not None:
+        if keys is None:
+            keys = self.game.getZobristKeys(canonicalBoard)
+
+        path, s, player = self._descend(canonicalBoard, keys, root_action=root_action)
+        depth = len(path)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        v = self.Es[s]
+        if v is not None:
             # terminal node
-            return self.Es[s]
-
-        if s not in self.Ps:
+            self.num_terminal += 1
+        else:
             # leaf node
-            self.Ps[s], v = self.nnet.predict(canonicalBoard)
-            valids = self.game.getValidMoves(canonicalBoard, 1)
-            self.Ps[s] = self.Ps[s] * valids  # masking invalid moves
-            sum_Ps_s = np.sum(self.Ps[s])
-            if sum_Ps_s > 0:
-                self.Ps[s] /= sum_Ps_s  # renormalize
+            # evaluated before the moves are taken back, so the board need not be copied
+            leaf = self.game.getCanonicalForm(canonicalBoard, player)
+            ps, v = self.nnet.predict(leaf)
+            self.num_nn_calls += 1
+            self.num_nn_positions += 1
+            v = v.item()
+            self.expand(s, leaf, ps, v)
+
+        # _undo and _backup without virtual loss, inlined as they run every simulation
+        undoMove = self.game.undoMove
+        leaf_v = v
+        for node, a in reversed(path):
+            undoMove(canonicalBoard, a)
+            v = -v
+            node.W[a] += v
+            node.N[a] += 1
+            node.Ns += 1
+        return leaf_v if depth % 2 == 0 else -leaf_v
+
+    def _descend(self, board, keys, vl=0, root_action=None):
+        """
+        Plays the highest upper confidence bound action on board, in place,
+        from the root down to the first terminal or unexpanded state, adding
+        a virtual loss of vl to every edge taken. root_action, if given, is
+        played at the root instead.
+
+        Returns:
+            path: list of (node, action) taken
+            s: key of the state reached, with its game end in self.Es
+            player: the player to move in that state, 1 being the root player
+        """
+        game, Es, nodes = self.game, self.Es, self.nodes
+        path = []
+        player, last_action, node = 1, None, None
+        while True:
+            s = keys[0]
+            if self.check_keys:
+                self._check_key(s, game.getCanonicalForm(board, player))
+            if node is not None:
+                node.children[last_action] = s
+            if s in Es:
+                end = Es[s]
             else:
-                # if all valid moves were masked make all valid moves equally probable
-                log.error("All valid moves were masked, doing a workaround.")
-                self.Ps[s] = self.Ps[s] + valids
-                self.Ps[s] /= np.sum(self.Ps[s])
-
-            self.Vs[s] = valids
-            self.Ns[s] = 0
-            return v
-
-        valids = self.Vs[s]
-        cur_best = -float("inf")
-        best_act = -1
-
-        # pick the action with the highest upper confidence bound
-        for a in range(self.game.getActionSize()):
-            if valids[a]:
-                u = self.Qsa.get((s, a), 0) + self.args.cpuct * self.Ps[s][
-                    a
-                ] * math.sqrt(self.Ns[s]) / (1 + self.Nsa.get((s, a), 0))
-
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
-
-        a = best_act
-        next_s, next_player = self.game.getNextState(canonicalBoard, 1, a)
-        next_s = self.game.getCanonicalForm(next_s, next_player)
-
-        v = -self.search(next_s)
-
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (
-                self.Nsa[(s, a)] + 1
-            )
-            self.Nsa[(s, a)] += 1
+                end = Es[s] = game.getGameEnded(board, player, last_action)
+            node = nodes.get(s) if end is None else None
+            if node is None:
+                return path, s, player
 
+            if root_action is None:
+                a = self.select(node)
+            else:
+                a, root_action = root_action, None
+            if vl:
+                node.N[a] += vl
+                node.W[a] -= vl
+                node.Ns += vl
+            path.append((node, a))
+
+            game.makeMove(board, player, a)
+            keys = game.getNextZobristKeys(keys, a)
+            player, last_action = -player, a
+
+    def _undo(self, board, path):
+        """Takes back the moves of path from board"""
+        for _, a in reversed(path):
+            self.game.undoMove(board, a)
+
+    def _leafBoard(self, board, player):
+        """The canonical form of board as a new board the search will not touch"""
+        leaf = self.game.getCanonicalForm(board, player)
+        return self.game.copyBoard(leaf) if leaf is board else leaf
+
+    def _check_key(self, s, canonicalBoard):
+        """Debugging aid: fails if key s was seen before for a different board"""
+        rep = self.game.stringRepresentation(canonicalBoard)
+        if self.boards.setdefault(s, rep) != rep:
+            log.error(f"Zobrist collision on key {s:#018x}")
+            assert self.boards[s] == rep
+
+    def select(self, node):
+        """Return the action with the highest upper confidence bound"""
+        # Q + cpuct * P * sqrt(Ns) / (1 + N), updated in place on one array
+        # as this runs at every level of every simulation
+        u = self.cpuct * node.P
+        u *= math.sqrt(node.Ns)
+        u /= node.N + 1
+        u += node.Q()
+        u += node.mask
+        return int(u.argmax())
+
+    def expand(self, s, canonicalBoard, ps, v=0.0):
+        """Create the node of leaf s from the policy ps and value v returned by the network"""
+        valids = self.game.getValidMoves(canonicalBoard, 1)
+        # masking invalid moves, in float64 like N and W so select does not mix dtypes
+        ps = np.multiply(ps, valids, dtype=np.float64)
+        sum_ps = np.sum(ps)
+        if sum_ps > 0:
+            ps /= sum_ps  # renormalize
         else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
+            # if all valid moves were masked make all valid moves equally probable
+            log.error("All valid moves were masked, doing a workaround.")
+            ps = ps + valids
+            ps /= np.sum(ps)
+
+        self.nodes[s] = MCTSNode(ps, valids, v)
+        self.num_expanded += 1
+
+    def searchBatch(self, canonicalBoard, batch_size, keys=None):
+        """
+        Runs up to batch_size simulations and evaluates all their leaves with
+        a single nnet.predict_batch call.
 
-        self.Ns[s] += 1
-        return v
+        Each descent adds a virtual loss to the edges it takes, so the next
+        descents of the same batch are steered towards other leaves. Once the
+        batch is evaluated the virtual losses are removed and the real values
+        are backed up. A descent that reaches a leaf already in the batch is
+        undone and not counted. As in search, canonicalBoard is modified in
+        place and restored.
+
+        Returns:
+            sims: the number of simulations that were backed up
+        """
+        vl = self.args.get("virtual_loss", 1.0)
+        pending = {}  # leaf s -> (canonical leaf board, path)
+        sims = 0
+        if keys is None:
+            keys = self.game.getZobristKeys(canonicalBoard)
+
+        for _ in range(batch_size):
+            path, s, player = self._descend(canonicalBoard, keys, vl)
+            if len(path) > self.max_depth:
+                self.max_depth = len(path)
+            if self.Es[s] is not None:
+                # terminal node, its value is known without the network
+                self.num_terminal += 1
+                self._backup(path, self.Es[s], vl)
+                sims += 1
+            elif s in pending:
+                self._backup(path, None, vl)
+            else:
+                pending[s] = (self._leafBoard(canonicalBoard, player), path)
+            self._undo(canonicalBoard, path)
+
+        if pending:
+            pis, vs = self.nnet.predict_batch([board for board, _ in pending.values()])
+            self.num_nn_calls += 1
+            self.num_nn_positions += len(pending)
+            for (s, (board, path)), ps, v in zip(pending.items(), pis, vs):
+                v = v.item()
+                self.expand(s, board, ps, v)
+                self._backup(path, v, vl)
+            sims += len(pending)
+
+        return sims
+
+    def prune(self, root):
+        """
+        Drops every state that can no longer be reached from board root.
+
+        Stones are never removed in Gomoku, so a state that is not below the
+        new root can never occur again and forgetting it loses nothing.
+        """
+        reachable = {root}
+        stack = [root]
+        while stack:
+            node = self.nodes.get(stack.pop())
+            if node is None:
+                continue
+            for child in node.children.values():
+                if child not in reachable:
+                    reachable.add(child)
+                    stack.append(child)
+
+        self.nodes = {k: v for k, v in self.nodes.items() if k in reachable}
+        self.Es = {k: v for k, v in self.Es.items() if k in reachable}
+        if self.boards:
+            self.boards = {k: v for k, v in self.boards.items() if k in reachable}
+
+    def evict(self, max_nodes, root):
+        """
+        Keeps the tree within max_nodes by dropping the least visited nodes,
+        down to 90% of the budget so that eviction does not run every
+        simulation. The root is always kept. An evicted state that is reached
+        again is simply expanded again.
+        """
+        keys = list(self.nodes)
+        visits = np.fromiter((n.Ns for n in self.nodes.values()), dtype=np.float64, count=len(keys))
+        if root in self.nodes:
+            visits[keys.index(root)] = np.inf
+        num_evict = min(len(keys) - int(max_nodes * 0.9), len(keys) - 1)
+        for i in np.argpartition(visits, num_evict)[:num_evict]:
+            del self.nodes[keys[i]]
+            self.Es.pop(keys[i], None)
+
+    def _backup(self, path, v, vl=0):
+        """
+        Removes the virtual loss along path and, unless v is None, backs up
+        the value v of the state path leads to.
+        """
+        for node, a in reversed(path):
+            if vl:
+                node.N[a] -= vl
+                node.W[a] += vl
+                node.Ns -= vl
+            if v is not None:
+                v = -v
+                node.W[a] += v
+                node.N[a] += 1
+                node.Ns += 1
 
 
 class GomokuNNet(nn.Module):
@@ -194,7 +529,8 @@ class GomokuNNet(nn.Module):
         s = F.relu(
             self.bn4(self.conv4(s))
         )  # batch_size x num_channels x (board_x-4) x (board_y-4)
-        s = s.view(-1, self.args.num_channels * (self.board_x - 4) * (self.board_y - 4))
+        # reshape rather than view, the activations may be channels_last
+        s = s.reshape(-1, self.args.num_channels * (self.board_x - 4) * (self.board_y - 4))
 
         s = F.dropout(
             F.relu(self.fc_bn1(self.fc1(s))),
@@ -213,6 +549,70 @@ class GomokuNNet(nn.Module):
         return F.log_softmax(pi, dim=1), torch.tanh(v)
 
 
+class ResidualBlock(nn.Module):
+    def __init__(self, channels):
+        super(ResidualBlock, self).__init__()
+        self.conv1 = nn.Conv2d(channels, channels, 3, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(channels)
+        self.conv2 = nn.Conv2d(channels, channels, 3, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(channels)
+
+    def forward(self, s):
+        out = F.relu(self.bn1(self.conv1(s)))
+        out = self.bn2(self.conv2(out))
+        return F.relu(out + s)
+
+
+class ResGomokuNNet(nn.Module):
+    """
+    Fully convolutional residual tower with the interface of GomokuNNet.
+
+    The policy head outputs one logit per board cell with a 1x1 convolution,
+    and the value head averages its feature maps over the board before the
+    fully connected layers, so no weight depends on the board size and a
+    checkpoint runs on any board_size.
+    """
+
+    def __init__(self, game, args):
+        self.board_x, self.board_y = game.getBoardSize()
+        self.action_size = game.getActionSize()
+        self.args = args
+        channels = args.num_channels
+
+        super(ResGomokuNNet, self).__init__()
+        self.conv = nn.Conv2d(1, channels, 3, padding=1, bias=False)
+        self.bn = nn.BatchNorm2d(channels)
+        self.blocks = nn.Sequential(*[ResidualBlock(channels) for _ in range(args.num_blocks)])
+
+        self.pi_conv = nn.Conv2d(channels, args.policy_channels, 1, bias=False)
+        self.pi_bn = nn.BatchNorm2d(args.policy_channels)
+        self.pi_out = nn.Conv2d(args.policy_channels, 1, 1)
+
+        self.v_conv = nn.Conv2d(channels, args.value_channels, 1, bias=False)
+        self.v_bn = nn.BatchNorm2d(args.value_channels)
+        self.v_fc1 = nn.Linear(args.value_channels, args.value_hidden)
+        self.v_fc2 = nn.Linear(args.value_hidden, 1)
+
+    def forward(self, s):
+        #                                                           s: batch_size x board_x x board_y
+        s = s.view(-1, 1, s.shape[-2], s.shape[-1])  # batch_size x 1 x board_x x board_y
+        s = F.relu(self.bn(self.conv(s)))  # batch_size x num_channels x board_x x board_y
+        s = self.blocks(s)  # batch_size x num_channels x board_x x board_y
+
+        pi = F.relu(self.pi_bn(self.pi_conv(s)))  # batch_size x policy_channels x board_x x board_y
+        pi = self.pi_out(pi).flatten(1)  # batch_size x action_size
+
+        v = F.relu(self.v_bn(self.v_conv(s)))  # batch_size x value_channels x board_x x board_y
+        v = v.mean(dim=(2, 3))  # batch_size x value_channels
+        v = F.dropout(F.relu(self.v_fc1(v)), p=self.args.dropout, training=self.training)
+        v = self.v_fc2(v)  # batch_size x 1
+
+        return F.log_softmax(pi, dim=1), torch.tanh(v)
+
+
+ARCHITECTURES = {"cnn": GomokuNNet, "resnet": ResGomokuNNet}
+
+
 class AverageMeter(object):
     """From https://github.com/pytorch/examples/blob/master/imagenet/main.py"""
 
@@ -232,15 +632,63 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class PredictHandle:
+    """
+    Single-position inference on a NNetWrapper with as little work per call
+    as possible. The board is copied into a preallocated input tensor, the
+    network runs under inference_mode and the returned policy and value are
+    numpy views of its output tensors.
+
+    It relies on NNetWrapper keeping the network in eval mode outside of
+    train().
+    """
+
+    def __init__(self, nnet):
+        self.nnet = nnet
+        self.input = torch.zeros(1, nnet.board_x, nnet.board_y)
+        self.input_np = self.input.numpy()[0]
+        self.device_input = self.input.cuda() if nnet.args.cuda else self.input
+
+    def predict(self, board):
+        np.copyto(self.input_np, np.asarray(board), casting="unsafe")
+        with torch.inference_mode():
+            if self.device_input is not self.input:
+                self.device_input.copy_(self.input, non_blocking=True)
+            pi, v = self.nnet._forward(self.device_input)
+            pi = pi.exp_()
+        if pi.is_cuda:
+            pi, v = pi.cpu(), v.cpu()
+        return pi.numpy()[0], v.numpy()[0]
+
+
 class NNetWrapper:
     def __init__(self, game, args):
-        self.nnet = GomokuNNet(game, args)
+        self.architecture = args.get("architecture", "cnn")
+        if self.architecture not in ARCHITECTURES:
+            raise ValueError("not support architecture {}".format(self.architecture))
+        self.nnet = ARCHITECTURES[self.architecture](game, args)
+        self.game = game
         self.board_x, self.board_y = game.getBoardSize()
         self.action_size = game.getActionSize()
         self.args = args
 
+        # evaluations shared by every MCTS that uses these weights
+        cache_size = args.get("eval_cache_size", 0)
+        self.cache = inference.EvalCache(cache_size) if cache_size else None
+
         if args.cuda:
             self.nnet.cuda()
+
+        # execution mode: bfloat16 autocast, channels_last weights and torch.compile
+        self.device_type = "cuda" if args.cuda else "cpu"
+        self.autocast = args.get("precision", "float32") == "bfloat16"
+        if args.get("channels_last", False):
+            self.nnet.to(memory_format=torch.channels_last)
+        # self.model shares its parameters with self.nnet, checkpoints keep using self.nnet
+        self.model = torch.compile(self.nnet, dynamic=True) if args.get("compile", False) else self.nnet
+        # eval mode except inside train(), so predictions never switch modes
+        self.nnet.eval()
+        self.handle = PredictHandle(self)
         
         # Initialize optimizer
         self.optimizer = optim.Adam(self.nnet.parameters(), lr=args.max_lr)
@@ -268,37 +716,95 @@ class NNetWrapper:
         
         return lr
 
+    def execution_mode(self):
+        mode = ["bfloat16" if self.autocast else "float32"]
+        if self.args.get("channels_last", False):
+            mode.append("channels_last")
+        if self.model is not self.nnet:
+            mode.append("compile")
+        return "+".join(mode)
+
+    def _forward(self, boards):
+        """Runs the network in the configured execution mode, returns float32 (log_pi, v)"""
+        with torch.autocast(self.device_type, dtype=torch.bfloat16, enabled=self.autocast):
+            pi, v = self.model(boards)
+        return pi.float(), v.float()
+
+    def check_execution_mode(self, num_boards=64, atol=0.05):
+        """
+        Compares the configured execution mode with eager float32 on random
+        boards. Returns the largest absolute differences of the policy
+        probabilities and of the values, and logs a warning if either is
+        above atol.
+        """
+        boards = torch.randint(-1, 2, (num_boards, self.board_x, self.board_y)).float()
+        if self.args.cuda:
+            boards = boards.cuda()
+        self.nnet.eval()
+        with torch.no_grad():
+            ref_pi, ref_v = self.nnet(boards)
+            pi, v = self._forward(boards)
+        pi_diff = (torch.exp(pi) - torch.exp(ref_pi)).abs().max().item()
+        v_diff = (v - ref_v).abs().max().item()
+        if max(pi_diff, v_diff) > atol:
+            log.warning(
+                f"Execution mode {self.execution_mode()} differs from float32: "
+                f"pi {pi_diff:.2e}, v {v_diff:.2e} > {atol}"
+            )
+        else:
+            log.info(f"Execution mode {self.execution_mode()} matches float32: pi {pi_diff:.2e}, v {v_diff:.2e}")
+        return pi_diff, v_diff
+
     def train(self, examples):
         """
-        examples: list of examples, each example is of form (board, pi, v)
+        examples: a replay.ReplayBuffer or replay.DiskReplayBuffer, or a list
+                  of examples, each example is of form (board, pi, v)
         """
+        if self.cache is not None:
+            self.cache.clear()
+        if isinstance(examples, (list, deque)):
+            examples = replay.ReplayBuffer.from_examples(examples)
+        lazy_symmetries = self.args.get("lazy_symmetries", False)
+
         for epoch in range(self.args.epochs):
             print("EPOCH ::: " + str(epoch + 1))
             self.nnet.train()
             pi_losses = AverageMeter()
             v_losses = AverageMeter()
+            data_time = AverageMeter()  # seconds per step waiting for the batch
+            compute_time = AverageMeter()  # seconds per step in forward, backward and update
 
             batch_count = int(len(examples) / self.args.batch_size)
+            if lazy_symmetries:
+                # as many steps as over the 8 stored symmetries of every position
+                batch_count *= 8
+
+            batches = replay.BatchPrefetcher(
+                examples,
+                self.args.batch_size,
+                batch_count,
+                transform=self.game.getBatchSymmetries if lazy_symmetries else None,
+                prefetch=self.args.get("prefetch_batches", 2),
+                pin_memory=self.args.cuda,
+            )
+            t = tqdm(batches, desc="Training Net")
+            end = time.perf_counter()
+            for boards, target_pis, target_vs in t:
+                data_time.update(time.perf_counter() - end)
 
-            t = tqdm(range(batch_count), desc="Training Net")
-            for _ in t:
                 # Update learning rate
                 lr = self.get_learning_rate()
                 for param_group in self.optimizer.param_groups:
                     param_group['lr'] = lr
                 self.current_step += 1
 
-                sample_ids = np.random.randint(len(examples), size=self.args.batch_size)
-                boards, pis, vs = list(zip(*[examples[i] for i in sample_ids]))
-                boards = torch.FloatTensor(np.array(boards).astype(np.float32))
-                target_pis = torch.FloatTensor(np.array(pis))
-                target_vs = torch.FloatTensor(np.array(vs).astype(np.float32))
-
                 if self.args.cuda:
-                    boards, target_pis, target_vs = boards.cuda(), target_pis.cuda(), target_vs.cuda()
+                    boards = boards.cuda(non_blocking=True)
+                    target_pis = target_pis.cuda(non_blocking=True)
+                    target_vs = target_vs.cuda(non_blocking=True)
 
                 # compute output
-                out_pi, out_v = self.nnet(boards)
+                out_pi, out_v = self._forward(boards)
                 l_pi = self.loss_pi(target_pis, out_pi)
                 l_v = self.loss_v(target_vs, out_v)
                 total_loss = l_pi + l_v
@@ -317,6 +823,7 @@ class NNetWrapper:
                     torch.nn.utils.clip_grad_norm_(self.nnet.parameters(), self.args.grad_clip)
                 
                 self.optimizer.step()
+                compute_time.update(time.perf_counter() - end - data_time.val)
 
                 if getattr(self.args, 'wandb', False):
                     wandb.log({
@@ -324,27 +831,68 @@ class NNetWrapper:
                         'policy_loss': l_pi.item(),
                         'value_loss': l_v.item(),
                         'total_loss': total_loss.item(),
+                        'data_time': data_time.val,
+                        'compute_time': compute_time.val,
                         'current_step': self.current_step,
                     })
+                end = time.perf_counter()
+
+            self.train_stats = {"data_ms": data_time.avg * 1000, "compute_ms": compute_time.avg * 1000}
+            log.info(
+                f"Epoch {epoch + 1}: data {data_time.avg * 1000:.2f} ms/step, "
+                f"compute {compute_time.avg * 1000:.2f} ms/step"
+            )
+
+        self.nnet.eval()
 
     def predict(self, board):
         """
         board: np array with board
         """
-        # timing
-        # start = time.time()
+        if self.cache is not None:
+            key, k = self.cache.key(board)
+            cached = self.cache.get(key, k)
+            if cached is not None:
+                return cached
+
+        pi, v = self.handle.predict(board)
+        if self.cache is not None:
+            self.cache.put(key, k, pi, v)
+        return pi, v
+
+    def predict_batch(self, boards):
+        """
+        boards: list of np arrays with boards
 
-        # preparing input
-        board = torch.FloatTensor(board.astype(np.float32))
+        Returns:
+            pis: batch_size x action_size array of policies
+            vs: batch_size array of values
+        """
+        if self.cache is None:
+            return self._predict_batch(boards)
+
+        keys = [self.cache.key(b) for b in boards]
+        cached = [self.cache.get(key, k) for key, k in keys]
+        misses = [i for i, c in enumerate(cached) if c is None]
+        if misses:
+            pis, vs = self._predict_batch([boards[i] for i in misses])
+            for j, i in enumerate(misses):
+                cached[i] = (pis[j], vs[j : j + 1])
+                self.cache.put(*keys[i], *cached[i])
+
+        pis = np.stack([pi for pi, _ in cached])
+        vs = np.array([v[0] for _, v in cached], dtype=np.float32)
+        return pis, vs
+
+    def _predict_batch(self, boards):
+        boards = torch.FloatTensor(np.array([np.asarray(b, dtype=np.float32) for b in boards]))
         if self.args.cuda:
-            board = board.cuda()
-        board = board.view(1, self.board_x, self.board_y)
-        self.nnet.eval()
-        with torch.no_grad():
-            pi, v = self.nnet(board)
+            boards = boards.cuda()
+        boards = boards.view(-1, self.board_x, self.board_y)
+        with torch.inference_mode():
+            pi, v = self._forward(boards)
 
-        # print('PREDICTION TIME TAKEN : {0:03f}'.format(time.time()-start))
-        return torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0]
+        return torch.exp(pi).data.cpu().numpy(), v.data.cpu().numpy()[:, 0]
 
     def loss_pi(self, targets, outputs):
         return -torch.sum(targets * outputs) / targets.size()[0]
@@ -366,6 +914,7 @@ class NNetWrapper:
         torch.save(
             {
                 "state_dict": self.nnet.state_dict(),
+                "architecture": self.architecture,
             },
             filepath,
         )
@@ -377,7 +926,90 @@ class NNetWrapper:
             raise ValueError("No model in path {}".format(filepath))
         map_location = None if self.args.cuda else "cpu"
         checkpoint = torch.load(filepath, map_location=map_location, weights_only=True)
+        # checkpoints from before the architecture option are all cnn
+        architecture = checkpoint.get("architecture", "cnn")
+        if architecture != self.architecture:
+            raise ValueError(
+                "Checkpoint {} holds a {} network, the config selects {}".format(
+                    filepath, architecture, self.architecture
+                )
+            )
         self.nnet.load_state_dict(checkpoint["state_dict"])
+        if self.cache is not None:
+            self.cache.clear()
+
+    def export(self, folder="checkpoint", filename="best.int8.pt", quantize=True):
+        """
+        Writes the network as a frozen TorchScript model for inference on
+        the CPU, with the linear layers dynamically quantized to int8 if
+        quantize. Load it with ScriptedNNet.
+        """
+        model = copy.deepcopy(self.nnet).cpu().float().eval()
+        with warnings.catch_warnings():
+            # TorchScript and torch.ao are deprecated in favour of torch.export/torchao but still supported
+            warnings.filterwarnings("ignore", message=".*deprecated")
+            if quantize:
+                model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+            example = torch.zeros(2, self.board_x, self.board_y)
+            with torch.no_grad():
+                scripted = torch.jit.freeze(torch.jit.trace(model, example))
+            filepath = os.path.join(folder, filename)
+            scripted.save(filepath)
+        return filepath
+
+
+class ScriptedNNet:
+    """
+    Inference-only network loaded from a NNetWrapper.export file, with the
+    predict and predict_batch interface of NNetWrapper. It builds neither
+    GomokuNNet nor an optimizer.
+    """
+
+    def __init__(self, game, filepath):
+        if not os.path.exists(filepath):
+            raise ValueError("No model in path {}".format(filepath))
+        self.board_x, self.board_y = game.getBoardSize()
+        self.action_size = game.getActionSize()
+        self.cache = None
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message=".*deprecated")
+            self.model = torch.jit.load(filepath, map_location="cpu")
+
+    def predict(self, board):
+        """
+        board: np array with board
+        """
+        pis, vs = self.predict_batch([board])
+        return pis[0], vs[:1]
+
+    def predict_batch(self, boards):
+        """
+        boards: list of np arrays with boards
+
+        Returns:
+            pis: batch_size x action_size array of policies
+            vs: batch_size array of values
+        """
+        boards = torch.from_numpy(np.array([np.asarray(b, dtype=np.float32) for b in boards]))
+        with torch.inference_mode():
+            pi, v = self.model(boards.view(-1, self.board_x, self.board_y))
+        return torch.exp(pi).numpy(), v.numpy()[:, 0]
+
+    def agreement(self, nnet, boards):
+        """
+        Compares the predictions with those of nnet on boards. Returns the
+        fraction of boards with the same most likely legal move and the
+        largest absolute differences of the policies and values.
+        """
+        pis, vs = self.predict_batch(boards)
+        ref_pis, ref_vs = nnet.predict_batch(boards)
+        valids = np.array([np.asarray(b).ravel() == 0 for b in boards])
+        same = np.argmax(np.where(valids, pis, -1), axis=1) == np.argmax(np.where(valids, ref_pis, -1), axis=1)
+        return {
+            "move_agreement": float(same.mean()),
+            "max_pi_diff": float(np.abs(pis - ref_pis).max()),
+            "max_v_diff": float(np.abs(vs - ref_vs).max()),
+        }
 
 
 class SelfPlay:
@@ -388,10 +1020,32 @@ class SelfPlay:
     def __init__(self, game, nnet, args):
         self.game = game
         self.nnet = nnet
-        self.pnet = self.nnet.__class__(self.game, args)  # the competitor network
+        self.pnet = None  # the competitor network, built on first use
         self.args = args
         self.mcts = MCTS(self.game, self.nnet, self.args)
-        self.trainExamplesHistory = []  # history of examples from args.numItersForTrainExamplesHistory latest iterations
+        # history of examples from args.numItersForTrainExamplesHistory latest iterations,
+        # built on first use so self-play workers never allocate or open it
+        self.replay = None
+        # per-iteration timings and counters, switched on by learn()
+        self.metrics = metrics.NullMetrics()
+
+    def makeReplay(self):
+        pi_dtype = np.dtype(self.args.get("replay_pi_dtype", "float16"))
+        if self.args.get("replay_on_disk", False):
+            # memory-mapped iteration files in the checkpoint dir, reloaded on restart
+            return replay.DiskReplayBuffer(
+                os.path.join(self.args.checkpoint, "replay"),
+                self.game.n,
+                self.args.numItersForTrainExamplesHistory,
+                pi_dtype,
+            )
+        return replay.ReplayBuffer(
+            self.game.n,
+            self.args.get("replay_capacity")
+            or self.args.maxlenOfQueue * self.args.numItersForTrainExamplesHistory,
+            self.args.numItersForTrainExamplesHistory,
+            pi_dtype,
+        )
 
     def executeEpisode(self):
         """
@@ -404,6 +1058,16 @@ class SelfPlay:
         It uses a temp=1 if episodeStep < tempThreshold, and thereafter
         uses temp=0.
 
+        With full_search_prob < 1 (playout cap randomization) only that
+        fraction of the moves is searched with numMCTSSims and recorded. The
+        others get a fast_sims search that only picks the move, so the games
+        are cheaper while every recorded policy target comes from a full
+        search. The value targets are the outcomes of those games as usual.
+
+        With search_mode "gumbel" the example's pi is always the
+        improved policy and the move is the one sequential halving selected,
+        whose Gumbel noise already provides the exploration.
+
         Returns:
             trainExamples: a list of examples of the form (canonicalBoard, pi, v)
         """
@@ -415,19 +1079,33 @@ class SelfPlay:
         while True:
             episodeStep += 1
             canonicalBoard = self.game.getCanonicalForm(board, self.curPlayer)
-            temp = int(episodeStep < self.args.tempThreshold)
-
-            pi = self.mcts.getActionProb(canonicalBoard, temp=temp)
-            sym = self.game.getSymmetries(canonicalBoard, pi)
+            gumbel = self.args.get("search_mode", "puct") == "gumbel"
+            temp = int(gumbel or episodeStep < self.args.tempThreshold)
+
+            full_prob = self.args.get("full_search_prob", 1.0)
+            full = full_prob >= 1 or np.random.random() < full_prob
+            num_sims = None if full else self.args.get("fast_sims", 100)
+
+            pi = self.mcts.getActionProb(canonicalBoard, temp=temp, num_sims=num_sims)
+            if not full:
+                sym = []
+            elif self.args.get("lazy_symmetries", False):
+                # one example per position, train() draws a random symmetry per batch
+                sym = [(np.asarray(canonicalBoard, dtype=np.int8), pi)]
+            else:
+                sym = self.game.getSymmetries(canonicalBoard, pi)
             for b, p in sym:
                 trainExamples.append([b, self.curPlayer, p, None])
 
-            action = np.random.choice(len(pi), p=pi)
+            if gumbel:
+                action = self.mcts.selected_action
+            else:
+                action = np.random.choice(len(pi), p=pi)
             board, self.curPlayer = self.game.getNextState(
                 board, self.curPlayer, action
             )
 
-            r = self.game.getGameEnded(board, self.curPlayer)
+            r = self.game.getGameEnded(board, self.curPlayer, action)
 
             if r is not None:
                 # r * (1 if self.curPlayer == x[1] else -1) means 1 for winner, -1 for loser, 0 for draw.
@@ -436,6 +1114,121 @@ class SelfPlay:
                     for x in trainExamples
                 ]
 
+    def playEpisode(self, seed):
+        """
+        Plays one episode with np.random seeded from seed on a new search tree.
+
+        Returns:
+            examples: the executeEpisode examples
+            stats: the MCTS.stats() of the episode
+        """
+        np.random.seed(seed)
+        self.mcts = MCTS(self.game, self.nnet, self.args)  # reset search tree
+        return self.executeEpisode(), self.mcts.stats()
+
+    def executeEpisodes(self, iteration):
+        """
+        Plays the numEps self-play episodes of one iteration.
+
+        Episode j of iteration i is seeded from (seed, i, j), so the examples
+        do not depend on num_workers. With num_workers > 1 the episodes are
+        spread over a pool of worker processes that each load the current
+        weights once, and they are streamed back in order.
+
+        With inference_server set the workers hold no network at all. They
+        send their boards to an InferenceServer in this process, which batches
+        the requests of all workers on self.nnet.
+
+        Returns:
+            iterationTrainExamples: deque of the examples of all episodes
+        """
+        iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
+        num_workers = self.args.get("num_workers", 1)
+
+        seeds = [
+            np.random.SeedSequence([self.args.get("seed", 0), iteration, j]).generate_state(1)[0]
+            for j in range(self.args.numEps)
+        ]
+
+        if num_workers <= 1:
+            # the episodes reseed np.random, leave it as the worker pool would
+            state = np.random.get_state()
+            for seed in tqdm(seeds, desc="Self Play"):
+                examples, mcts_stats = self.playEpisode(seed)
+                self.metrics.add("selfplay_examples", len(examples))
+                self.metrics.add_mcts(mcts_stats)
+                iterationTrainExamples += examples
+            np.random.set_state(state)
+            return iterationTrainExamples
+        ctx = game.worker_context()
+
+        server = None
+        if self.args.get("inference_server", False):
+            server = inference.InferenceServer(
+                self.nnet,
+                ctx,
+                num_workers,
+                rows_per_client=max(1, self.args.get("mcts_batch_size", 1)),
+                max_batch=self.args.get("inference_max_batch", 64),
+                max_wait_ms=self.args.get("inference_max_wait_ms", 2.0),
+            ).start()
+            initializer = _init_selfplay_worker_client
+            initargs = (self.game, self.args, server.client())
+        else:
+            self.nnet.save_checkpoint(
+                folder=self.args.checkpoint, filename="selfplay.pth.tar"
+            )
+            initializer = _init_selfplay_worker
+            initargs = (self.game, self.args, self.args.checkpoint, "selfplay.pth.tar")
+
+        with game.worker_pool(num_workers, initializer, *initargs, ctx=ctx) as pool:
+            for examples, mcts_stats in tqdm(
+                pool.imap(_play_selfplay_episode, seeds),
+                total=self.args.numEps,
+                desc=f"Self Play ({num_workers} workers)",
+            ):
+                self.metrics.add("selfplay_examples", len(examples))
+                self.metrics.add_mcts(mcts_stats)
+                iterationTrainExamples += examples
+
+        if server is not None:
+            server.stop()
+            self.inference_stats = server.stats()
+            log.info(f"Inference server: {self.inference_stats}")
+            self.metrics.set("inference_mean_batch_size", self.inference_stats["mean_batch_size"])
+            self.metrics.set("inference_latency_ms_p95", self.inference_stats["latency_ms_p95"])
+        return iterationTrainExamples
+
+    def pit(self, iteration, sprt=None):
+        """
+        Plays arenaCompare games of self.pnet, loaded from temp.pth.tar,
+        against self.nnet. With sprt, a game.SPRT on the win rate of
+        self.nnet, the arena stops as soon as the test is decided.
+
+        With arena_workers > 1 the games are spread over a pool of worker
+        processes, each loading both networks once and building new MCTS
+        trees for every game.
+
+        Returns:
+            pwins, nwins, draws
+        """
+        arena_workers = self.args.get("arena_workers", 1)
+        if arena_workers <= 1:
+            pmcts = MCTS(self.game, self.pnet, self.args)
+            nmcts = MCTS(self.game, self.nnet, self.args)
+            arena = game.Arena(
+                lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
+                lambda x: np.argmax(nmcts.getActionProb(x, temp=0)),
+                self.game,
+            )
+            return arena.playGames(self.args.arenaCompare, sprt=sprt)
+
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename="arena.pth.tar")
+        players = MCTSPlayers(self.game, self.args, self.args.checkpoint, "temp.pth.tar", "arena.pth.tar")
+        arena = game.Arena(None, None, self.game)
+        seed = np.random.SeedSequence([self.args.get("seed", 0), iteration]).generate_state(1)[0]
+        return arena.playGamesParallel(self.args.arenaCompare, arena_workers, players, seed=seed, sprt=sprt)
+
     def learn(self):
         """
         Performs numIters iterations with numEps episodes of self-play in each
@@ -444,74 +1237,151 @@ class SelfPlay:
         It then pits the new neural network against the old one and accepts it
         only if it wins >= updateThreshold fraction of games.
         """
+        if self.replay is None:
+            self.replay = self.makeReplay()
+        if self.args.get("metrics", True):
+            self.metrics = metrics.Metrics(
+                os.path.join(self.args.checkpoint, self.args.get("metrics_file", "metrics.jsonl")),
+                use_wandb=self.args.get("wandb", False),
+            )
 
         for i in range(1, self.args.numIters + 1):
             # bookkeeping
             log.info(f"Starting Iter #{i} ...")
             # examples of the iteration
-            iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
-
-            for _ in tqdm(range(self.args.numEps), desc="Self Play"):
-                self.mcts = MCTS(self.game, self.nnet, self.args)  # reset search tree
-                iterationTrainExamples += self.executeEpisode()
+            if self.nnet.cache is not None:
+                self.nnet.cache.reset_stats()
+            with self.metrics.phase("selfplay"):
+                iterationTrainExamples = self.executeEpisodes(i)
+            if self.nnet.cache is not None:
+                log.info(f"Eval cache: {self.nnet.cache.stats()}")
+                self.metrics.set("eval_cache_hit_rate", self.nnet.cache.stats()["hit_rate"])
 
             # save the iteration examples to the history
-            self.trainExamplesHistory.append(iterationTrainExamples)
-
-            if (
-                len(self.trainExamplesHistory)
-                > self.args.numItersForTrainExamplesHistory
-            ):
+            if len(self.replay.iterations) >= self.args.numItersForTrainExamplesHistory:
                 log.warning(
-                    f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.trainExamplesHistory)}"
+                    f"Removing the oldest iteration in the replay buffer. iterations = {len(self.replay.iterations)}"
                 )
-                self.trainExamplesHistory.pop(0)
-
-            # shuffle examples before training
-            trainExamples = []
-            for e in self.trainExamplesHistory:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+            with self.metrics.phase("replay"):
+                self.replay.add_iteration(iterationTrainExamples)
+            self.metrics.set("replay_examples", len(self.replay))
 
             # training new network, keeping a copy of the old one
-            self.nnet.save_checkpoint(
-                folder=self.args.checkpoint, filename="temp.pth.tar"
-            )
-            self.pnet.load_checkpoint(
-                folder=self.args.checkpoint, filename="temp.pth.tar"
-            )
-            pmcts = MCTS(self.game, self.pnet, self.args)
+            with self.metrics.phase("checkpoint"):
+                self.nnet.save_checkpoint(
+                    folder=self.args.checkpoint, filename="temp.pth.tar"
+                )
+                if self.pnet is None:
+                    self.pnet = self.nnet.__class__(self.game, self.args)
+                self.pnet.load_checkpoint(
+                    folder=self.args.checkpoint, filename="temp.pth.tar"
+                )
 
-            self.nnet.train(trainExamples)
-            nmcts = MCTS(self.game, self.nnet, self.args)
+            # the replay buffer samples uniformly, so no shuffle is needed
+            with self.metrics.phase("train"):
+                self.nnet.train(self.replay)
+            self.metrics.set("train_data_ms", self.nnet.train_stats["data_ms"])
+            self.metrics.set("train_compute_ms", self.nnet.train_stats["compute_ms"])
 
             log.info("PITTING AGAINST PREVIOUS VERSION")
-            arena = game.Arena(
-                lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
-                lambda x: np.argmax(nmcts.getActionProb(x, temp=0)),
-                self.game,
-            )
-            pwins, nwins, draws = arena.playGames(self.args.arenaCompare)
+            sprt = None
+            if self.args.get("arena_sprt", False):
+                # tests the new network's win rate around updateThreshold
+                margin = self.args.get("sprt_margin", 0.1)
+                sprt = game.SPRT(
+                    max(self.args.updateThreshold - margin, 0.01),
+                    min(self.args.updateThreshold + margin, 0.99),
+                    self.args.get("sprt_alpha", 0.05),
+                    self.args.get("sprt_beta", 0.05),
+                )
+            with self.metrics.phase("arena"):
+                pwins, nwins, draws = self.pit(i, sprt)
+            self.metrics.set("arena_games", pwins + nwins + draws)
+            self.metrics.set("arena_new_wins", nwins)
 
             log.info("NEW/PREV WINS : %d / %d ; DRAWS : %d" % (nwins, pwins, draws))
-            if (
+            # an undecided SPRT falls back to the threshold on all games played
+            decision = sprt.decision() if sprt is not None else None
+            if decision == "reject" or decision is None and (
                 pwins + nwins == 0
                 or float(nwins) / (pwins + nwins) < self.args.updateThreshold
             ):
                 log.info("REJECTING NEW MODEL")
-                self.nnet.load_checkpoint(
-                    folder=self.args.checkpoint, filename="temp.pth.tar"
-                )
+                self.metrics.set("accepted", 0)
+                with self.metrics.phase("checkpoint"):
+                    self.nnet.load_checkpoint(
+                        folder=self.args.checkpoint, filename="temp.pth.tar"
+                    )
             else:
                 log.info("ACCEPTING NEW MODEL")
-                self.nnet.save_checkpoint(
-                    folder=self.args.checkpoint, filename="best.pth.tar"
-                )
+                self.metrics.set("accepted", 1)
+                with self.metrics.phase("checkpoint"):
+                    self.nnet.save_checkpoint(
+                        folder=self.args.checkpoint, filename="best.pth.tar"
+                    )
+            self.metrics.emit(i)
+
+
+class MCTSPlayers:
+    """
+    Picklable factory of the two MCTS players of an arena game, for
+    game.Arena.playGamesParallel. Each worker process loads the two
+    checkpoints the first time it is called, and every call returns players
+    with new search trees.
+    """
+
+    def __init__(self, game, args, folder, filename1, filename2):
+        self.game = game
+        self.args = args
+        self.files = (os.path.join(folder, filename1), os.path.join(folder, filename2))
+        self.nnets = None
+
+    def __getstate__(self):
+        # the networks are loaded in each worker, never pickled
+        return dict(self.__dict__, nnets=None)
+
+    def __call__(self):
+        if self.nnets is None:
+            torch.set_num_threads(self.args.get("worker_threads", 1))
+            self.nnets = []
+            for filepath in self.files:
+                nnet = NNetWrapper(self.game, self.args)
+                nnet.load_checkpoint(*os.path.split(filepath))
+                self.nnets.append(nnet)
+        mcts1, mcts2 = (MCTS(self.game, nnet, self.args) for nnet in self.nnets)
+        return (
+            lambda x: np.argmax(mcts1.getActionProb(x, temp=0)),
+            lambda x: np.argmax(mcts2.getActionProb(x, temp=0)),
+        )
+
+
+def _init_selfplay_worker(game, args, folder, filename):
+    # one thread per worker by default, the workers already use every core
+    torch.set_num_threads(args.get("worker_threads", 1))
+    nnet = NNetWrapper(game, args)
+    nnet.load_checkpoint(folder, filename)
+    return SelfPlay(game, nnet, args)
+
+
+def _init_selfplay_worker_client(game, args, client):
+    torch.set_num_threads(args.get("worker_threads", 1))
+    # the InferenceClient stands in for the network
+    return SelfPlay(game, client, args)
+
+
+def _play_selfplay_episode(seed):
+    return game.worker_state().playEpisode(seed)
 
 
 class dotdict(dict):
     def __getattr__(self, name):
-        return self[name]
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    # keep attribute writes in the dict so args.get() and pickling see them
+    __setattr__ = dict.__setitem__
 
 
 def load_config(config_path):
@@ -531,26 +1401,66 @@ def load_config(config_path):
     args.updateThreshold = config['training']['update_threshold']
     args.arenaCompare = config['training']['arena_compare']
     args.tempThreshold = config['training']['temp_threshold']
+    args.replay_capacity = config['training'].get('replay_capacity', None)
+    args.replay_pi_dtype = config['training'].get('replay_pi_dtype', 'float16')
+    args.replay_on_disk = config['training'].get('replay_on_disk', False)
+    args.lazy_symmetries = config['training'].get('lazy_symmetries', False)
+    args.prefetch_batches = config['training'].get('prefetch_batches', 2)
+    args.num_workers = config['training'].get('num_workers', 1)
+    args.arena_workers = config['training'].get('arena_workers', 1)
+    args.arena_sprt = config['training'].get('arena_sprt', False)
+    args.sprt_margin = config['training'].get('sprt_margin', 0.1)
+    args.sprt_alpha = config['training'].get('sprt_alpha', 0.05)
+    args.sprt_beta = config['training'].get('sprt_beta', 0.05)
+    args.seed = config['training'].get('seed', 0)
+    args.inference_server = config['training'].get('inference_server', False)
+    args.inference_max_batch = config['training'].get('inference_max_batch', 64)
+    args.inference_max_wait_ms = config['training'].get('inference_max_wait_ms', 2.0)
     
     # Network params
+    args.architecture = config['network'].get('architecture', 'cnn')
     args.num_channels = config['network']['num_channels']
+    args.num_blocks = config['network'].get('num_blocks', 6)
+    args.policy_channels = config['network'].get('policy_channels', 32)
+    args.value_channels = config['network'].get('value_channels', 32)
+    args.value_hidden = config['network'].get('value_hidden', 256)
     args.dropout = config['network']['dropout']
     args.min_lr = config['network']['learning_rate']['min']
     args.max_lr = config['network']['learning_rate']['max']
     args.grad_clip = config['network']['grad_clip']
+    args.precision = config['network'].get('precision', 'float32')
+    args.compile = config['network'].get('compile', False)
+    args.channels_last = config['network'].get('channels_last', False)
     
     # MCTS params
     args.numMCTSSims = config['mcts']['num_sims']
+    args.full_search_prob = config['mcts'].get('full_search_prob', 1.0)
+    args.fast_sims = config['mcts'].get('fast_sims', 100)
     args.cpuct = config['mcts']['cpuct']
+    args.search_mode = config['mcts'].get('search_mode', 'puct')
+    args.gumbel_num_actions = config['mcts'].get('gumbel_num_actions', 64)
+    args.gumbel_c_visit = config['mcts'].get('gumbel_c_visit', 50)
+    args.gumbel_c_scale = config['mcts'].get('gumbel_c_scale', 1.0)
+    args.mcts_batch_size = config['mcts'].get('batch_size', 1)
+    args.virtual_loss = config['mcts'].get('virtual_loss', 1.0)
+    args.mcts_prune = config['mcts'].get('prune', False)
+    args.mcts_max_nodes = config['mcts'].get('max_nodes', 0)
+    args.eval_cache_size = config['mcts'].get('eval_cache_size', 0)
+    args.zobrist_check = config['mcts'].get('zobrist_check', False)
     
     # Game params
     args.board_size = config['game']['board_size']
+    args.backend = config['game'].get('backend', 'array')
     
     # System params
     args.cuda = config['system']['cuda'] and torch.cuda.is_available()
     args.checkpoint = config['system']['checkpoint_dir']
     args.load_model = config['system']['load_model']
     args.load_folder_file = tuple(config['system']['load_folder_file'])
+    args.metrics = config['system'].get('metrics', True)
+    args.metrics_file = config['system'].get('metrics_file', 'metrics.jsonl')
+    args.num_threads = config['system'].get('num_threads', 0)
+    args.worker_threads = config['system'].get('worker_threads', 1)
     
     return args
 
@@ -565,28 +1475,69 @@ def print_config(args):
     print(f"  Episodes per Iteration: {args.numEps}")
     print(f"  Max Queue Length: {args.maxlenOfQueue}")
     print(f"  Training History Length: {args.numItersForTrainExamplesHistory}")
+    print(f"  Replay Capacity: {args.replay_capacity or args.maxlenOfQueue * args.numItersForTrainExamplesHistory}")
+    print(f"  Replay Policy dtype: {args.replay_pi_dtype}")
+    print(f"  Replay On Disk: {args.replay_on_disk}")
+    print(f"  Lazy Symmetries: {args.lazy_symmetries}")
+    print(f"  Prefetched Batches: {args.prefetch_batches}")
     print(f"  Update Threshold: {args.updateThreshold}")
     print(f"  Arena Compare Games: {args.arenaCompare}")
     print(f"  Temperature Threshold: {args.tempThreshold}")
+    print(f"  Self-Play Workers: {args.num_workers}")
+    print(f"  Arena Workers: {args.arena_workers}")
+    print(f"  Arena SPRT: {args.arena_sprt}")
+    if args.arena_sprt:
+        print(f"  SPRT Margin: {args.sprt_margin}")
+        print(f"  SPRT alpha/beta: {args.sprt_alpha}/{args.sprt_beta}")
+    print(f"  Seed: {args.seed}")
+    print(f"  Inference Server: {args.inference_server}")
+    if args.inference_server:
+        print(f"  Inference Max Batch: {args.inference_max_batch}")
+        print(f"  Inference Max Wait (ms): {args.inference_max_wait_ms}")
     
     print("\nNetwork Parameters:")
+    print(f"  Architecture: {args.architecture}")
     print(f"  Number of Channels: {args.num_channels}")
+    if args.architecture == "resnet":
+        print(f"  Residual Blocks: {args.num_blocks}")
+        print(f"  Policy/Value Head Channels: {args.policy_channels}/{args.value_channels}")
+        print(f"  Value Hidden Units: {args.value_hidden}")
     print(f"  Dropout: {args.dropout}")
     print(f"  Learning Rate Range: {args.min_lr} - {args.max_lr}")
     print(f"  Gradient Clip: {args.grad_clip}")
+    print(f"  Precision: {args.precision}")
+    print(f"  Compile: {args.compile}")
+    print(f"  Channels Last: {args.channels_last}")
     
     print("\nMCTS Parameters:")
     print(f"  MCTS Simulations: {args.numMCTSSims}")
+    if args.full_search_prob < 1:
+        print(f"  Playout Cap: {args.full_search_prob:.0%} of moves full, others {args.fast_sims} sims")
     print(f"  CPUCT: {args.cpuct}")
+    print(f"  Search Mode: {args.search_mode}")
+    if args.search_mode == "gumbel":
+        print(f"  Gumbel Actions: {args.gumbel_num_actions}")
+        print(f"  Gumbel c_visit / c_scale: {args.gumbel_c_visit} / {args.gumbel_c_scale}")
+    print(f"  Leaf Batch Size: {args.mcts_batch_size}")
+    print(f"  Virtual Loss: {args.virtual_loss}")
+    print(f"  Prune Unreachable: {args.mcts_prune}")
+    print(f"  Max Nodes: {args.mcts_max_nodes or 'unlimited'}")
+    print(f"  Eval Cache Size: {args.eval_cache_size or 'disabled'}")
+    if args.zobrist_check:
+        print("  Zobrist Collision Check: enabled")
     
     print("\nGame Parameters:")
     print(f"  Board Size: {args.board_size}")
+    print(f"  Backend: {args.backend}")
     
     print("\nSystem Parameters:")
     print(f"  CUDA Enabled: {args.cuda}")
     print(f"  Checkpoint Directory: {args.checkpoint}")
     print(f"  Load Model: {args.load_model}")
     print(f"  Load Path: {args.load_folder_file}")
+    print(f"  Metrics: {os.path.join(args.checkpoint, args.metrics_file) if args.metrics else 'disabled'}")
+    print(f"  Torch Threads: {args.num_threads or torch.get_num_threads()}")
+    print(f"  Torch Threads per Worker: {args.worker_threads}")
     print("==================\n")
 
 
@@ -614,6 +1565,10 @@ def main():
         choices=["human", "random", "greedy", "alphazero"],
     )
     parser.add_argument("--ckpt_file", type=str, default="best.pth.tar")
+    # export arguments
+    parser.add_argument("--export", action="store_true", help="Export ckpt_file as a TorchScript model for play")
+    parser.add_argument("--export_file", type=str, default="best.int8.pt")
+    parser.add_argument("--no_quantize", action="store_true", help="Export without int8 quantization")
     parser.add_argument("--wandb", action="store_true", help="Use wandb to record the training process")
     parser.add_argument("--wandb_project", type=str, default="alphazero-gomoku", help="wandb project name")
     parser.add_argument("--wandb_entity", type=str, default=None, help="wandb entity name")
@@ -627,10 +1582,16 @@ def main():
         if k != 'config':
             args[k] = v
     
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
     # Add this line to print configuration
     print_config(args)
     
-    g = game.GomokuGame(args.board_size)
+    if args.backend == "bitboard":
+        g = game.BitBoardGomokuGame(args.board_size)
+    else:
+        g = game.GomokuGame(args.board_size)
 
     if args.train:
         # Initialize wandb
@@ -644,6 +1605,7 @@ def main():
                     "num_episodes": args.numEps,
                     "num_mcts_sims": args.numMCTSSims,
                     "batch_size": args.batch_size,
+                    "architecture": args.architecture,
                     "num_channels": args.num_channels,
                     "learning_rate_min": args.min_lr,
                     "learning_rate_max": args.max_lr,
@@ -663,12 +1625,32 @@ def main():
             )
             nnet.load_checkpoint(args.load_folder_file[0], args.load_folder_file[1])
 
+        if nnet.execution_mode() != "float32":
+            nnet.check_execution_mode()
+
         log.info("Loading the SelfCoach...")
         s = SelfPlay(g, nnet, args)
 
         log.info("Starting the learning process 🎉")
         s.learn()
 
+    if args.export:
+        nnet = NNetWrapper(g, args)
+        nnet.load_checkpoint(args.checkpoint, args.ckpt_file)
+        filepath = nnet.export(args.checkpoint, args.export_file, quantize=not args.no_quantize)
+        log.info(f"Exported {args.ckpt_file} to {filepath}")
+
+        # positions of random games, to check the exported model against the checkpoint
+        boards = []
+        for _ in range(8):
+            board, player = g.getInitBoard(), 1
+            while g.getGameEnded(board, player) is None:
+                boards.append(np.asarray(g.getCanonicalForm(board, player)))
+                action = np.random.choice(np.flatnonzero(g.getValidMoves(board, player)))
+                board, player = g.getNextState(board, player, action)
+        scripted = ScriptedNNet(g, filepath)
+        log.info(f"Agreement with the checkpoint on {len(boards)} positions: {scripted.agreement(nnet, boards)}")
+
     if args.play:
         def getPlayFunc(name):
             if name == "human":
@@ -678,8 +1660,15 @@ def main():
             elif name == "greedy":
                 return game.GreedyGomokuPlayer(g).play
             elif name == "alphazero":
+                if args.ckpt_file.endswith(".pt"):
+                    # TorchScript model written by --export
+                    nnet = ScriptedNNet(g, os.path.join(args.checkpoint, args.ckpt_file))
+                    mcts = MCTS(g, nnet, dotdict({"numMCTSSims": 800, "cpuct": 1.0}))
+                    return lambda x: np.argmax(mcts.getActionProb(x, temp=0))
                 nnet = NNetWrapper(g, args)
                 nnet.load_checkpoint(args.checkpoint, args.ckpt_file)
+                if nnet.execution_mode() != "float32":
+                    nnet.check_execution_mode()
                 mcts = MCTS(g, nnet, dotdict({"numMCTSSims": 800, "cpuct": 1.0}))
                 return lambda x: np.argmax(mcts.getActionProb(x, temp=0))
             else:
@@ -0,0 +1,950 @@
+"""
+Micro-benchmarks for the hot paths of AlphaZero Gomoku.
+
+Usage:
+    python benchmark.py --board_size 15
+    python benchmark.py --board_size 15 --only game_ended
+
+The regression suite runs the primitives, mcts, inference and training
+benchmarks with fixed seeds at board sizes 9 and 15, writes the results
+as JSON and compares them with a saved baseline:
+    python benchmark.py --suite --output baseline.json
+    python benchmark.py --suite --output current.json --baseline baseline.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+import alphazero
+import game
+import replay
+
+
+def random_positions(g, num_games, rng):
+    """
+    Plays num_games uniformly random games.
+
+    Returns:
+        positions: list of (canonicalBoard, last_action) for every position
+                   reached, including the terminal ones
+    """
+    positions = []
+    for _ in range(num_games):
+        board = g.getInitBoard()
+        player = 1
+        action = None
+        while True:
+            positions.append((g.getCanonicalForm(board, player), action))
+            if g.getGameEnded(board, player, action) is not None:
+                break
+            valids = g.getValidMoves(board, player)
+            action = rng.choice(np.flatnonzero(valids))
+            board, player = g.getNextState(board, player, action)
+    return positions
+
+
+def make_args(args, **overrides):
+    """config.yaml settings with the benchmark's network size and overrides"""
+    nnet_args = alphazero.load_config(args.config)
+    nnet_args.board_size = args.board_size
+    nnet_args.num_channels = args.num_channels
+    nnet_args.cuda = False
+    nnet_args.update(overrides)
+    return nnet_args
+
+
+def make_game(nnet_args):
+    if nnet_args.backend == "bitboard":
+        return game.BitBoardGomokuGame(nnet_args.board_size)
+    return game.GomokuGame(nnet_args.board_size)
+
+
+def time_per_call(fn, calls, repeat=3):
+    """Best of repeat runs of fn over calls, in microseconds per call"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for c in calls:
+            fn(*c)
+        best = min(best, time.perf_counter() - start)
+    return best / len(calls) * 1e6
+
+
+def bench_game_ended(args):
+    """Full-board scan vs last-move check in GomokuGame.getGameEnded"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    positions = random_positions(g, args.num_games, rng)
+
+    # the root of a search has no last move, only time positions that have one
+    positions = [(b, a) for b, a in positions if a is not None]
+    for b, a in positions:
+        assert g.getGameEnded(b, 1) == g.getGameEnded(b, 1, a)
+
+    full = time_per_call(lambda b, a: g.getGameEnded(b, 1), positions)
+    incremental = time_per_call(lambda b, a: g.getGameEnded(b, 1, a), positions)
+    return {
+        "positions": len(positions),
+        "full_us": full,
+        "incremental_us": incremental,
+        "speedup": full / incremental,
+    }
+
+
+def expand_node(g, board, action):
+    """The game-logic calls MCTS.search makes for one new node"""
+    next_board, next_player = g.getNextState(board, 1, action)
+    next_board = g.getCanonicalForm(next_board, next_player)
+    g.stringRepresentation(next_board)
+    g.getGameEnded(next_board, 1, action)
+    g.getValidMoves(next_board, 1)
+
+
+def bench_backends(args):
+    """Per-node game-logic time of the array and bitboard GomokuGame backends"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    bg = game.BitBoardGomokuGame(args.board_size)
+
+    calls, bit_calls = [], []
+    for b, _ in random_positions(g, args.num_games, rng):
+        if g.getGameEnded(b, 1) is not None:
+            continue
+        a = rng.choice(np.flatnonzero(g.getValidMoves(b, 1)))
+        bb = game.BitBoard.from_array(b)
+
+        # both backends must agree on every primitive
+        nb, p = g.getNextState(b, 1, a)
+        nbb, bp = bg.getNextState(bb, 1, a)
+        assert p == bp and np.array_equal(nb, np.asarray(nbb))
+        nb, nbb = g.getCanonicalForm(nb, p), bg.getCanonicalForm(nbb, bp)
+        assert np.array_equal(nb, np.asarray(nbb))
+        assert g.getGameEnded(nb, 1) == bg.getGameEnded(nbb, 1) == bg.getGameEnded(nbb, 1, a)
+        assert np.array_equal(g.getValidMoves(nb, 1), bg.getValidMoves(nbb, 1))
+
+        calls.append((b, a))
+        bit_calls.append((bb, a))
+
+    array_us = time_per_call(lambda b, a: expand_node(g, b, a), calls)
+    bitboard_us = time_per_call(lambda b, a: expand_node(bg, b, a), bit_calls)
+    return {
+        "positions": len(calls),
+        "array_us": array_us,
+        "bitboard_us": bitboard_us,
+        "speedup": array_us / bitboard_us,
+    }
+
+
+def bench_mcts_batch(args):
+    """MCTS.getActionProb sims/sec for several leaf batch sizes K"""
+    torch.manual_seed(args.seed)
+    nnet_args = make_args(args, numMCTSSims=args.num_sims)
+    g = make_game(nnet_args)
+    nnet = alphazero.NNetWrapper(g, nnet_args)
+
+    result = {}
+    for k in args.batch_sizes:
+        nnet_args.mcts_batch_size = k
+        mcts = alphazero.MCTS(g, nnet, nnet_args)
+        start = time.perf_counter()
+        mcts.getActionProb(g.getInitBoard(), temp=1)
+        result[f"K={k}_sims_per_sec"] = args.num_sims / (time.perf_counter() - start)
+    return result
+
+
+def bench_selfplay(args):
+    """Self-play episodes/sec of SelfPlay.executeEpisodes for several worker counts"""
+    torch.manual_seed(args.seed)
+    nnet_args = make_args(
+        args,
+        numMCTSSims=args.num_sims,
+        numEps=args.num_episodes,
+        inference_server=args.inference_server,
+    )
+    g = make_game(nnet_args)
+    nnet = alphazero.NNetWrapper(g, nnet_args)
+
+    result = {}
+    with tempfile.TemporaryDirectory() as folder:
+        nnet_args.checkpoint = folder
+        for workers in args.worker_counts:
+            nnet_args.num_workers = workers
+            coach = alphazero.SelfPlay(g, nnet, nnet_args)
+            start = time.perf_counter()
+            coach.executeEpisodes(1)
+            result[f"workers={workers}_episodes_per_sec"] = args.num_episodes / (
+                time.perf_counter() - start
+            )
+            if nnet_args.inference_server and workers > 1:
+                result[f"workers={workers}_inference_server"] = coach.inference_stats
+    result["cpu_count"] = os.cpu_count()
+    return result
+
+
+def bench_playout_cap(args):
+    """
+    Self-play with every move fully searched vs playout cap randomization
+    (a quarter of the moves get num_sims, the rest num_sims / 8): episodes
+    and recorded examples per second
+    """
+    result = {}
+    for full_prob in (1.0, 0.25):
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        nnet_args = make_args(
+            args,
+            numMCTSSims=args.num_sims,
+            numEps=args.num_episodes,
+            num_workers=1,
+            full_search_prob=full_prob,
+            fast_sims=max(1, args.num_sims // 8),
+        )
+        g = make_game(nnet_args)
+        coach = alphazero.SelfPlay(g, alphazero.NNetWrapper(g, nnet_args), nnet_args)
+        start = time.perf_counter()
+        examples = coach.executeEpisodes(1)
+        seconds = time.perf_counter() - start
+        result[f"full{full_prob}_episodes_per_sec"] = args.num_episodes / seconds
+        result[f"full{full_prob}_examples_per_sec"] = len(examples) / seconds
+    return result
+
+
+def bench_mcts_memory(args):
+    """MCTS tree size over one game without pruning, with pruning, and with a node budget"""
+    torch.manual_seed(args.seed)
+    nnet_args = make_args(args, numMCTSSims=args.num_sims)
+    g = make_game(nnet_args)
+    nnet = alphazero.NNetWrapper(g, nnet_args)
+
+    result = {}
+    for name, prune, max_nodes in [
+        ("no_prune", False, 0),
+        ("prune", True, 0),
+        ("prune_budget", True, args.num_sims),
+    ]:
+        nnet_args.mcts_prune, nnet_args.mcts_max_nodes = prune, max_nodes
+        mcts = alphazero.MCTS(g, nnet, nnet_args)
+        board, player, action = g.getInitBoard(), 1, None
+        sizes = []
+        while g.getGameEnded(board, player, action) is None:
+            action = int(np.argmax(mcts.getActionProb(g.getCanonicalForm(board, player), temp=0)))
+            board, player = g.getNextState(board, player, action)
+            sizes.append(len(mcts.nodes))
+        result[f"{name}_max_nodes"] = max(sizes)
+        result[f"{name}_final_nodes"] = sizes[-1]
+    return result
+
+
+def bench_eval_cache(args):
+    """Self-play time and symmetric eval cache hit rate with and without the cache"""
+    result = {}
+    for cache_size in (0, args.eval_cache_size):
+        torch.manual_seed(args.seed)
+        nnet_args = make_args(
+            args,
+            numMCTSSims=args.num_sims,
+            numEps=args.num_episodes,
+            num_workers=1,
+            eval_cache_size=cache_size,
+        )
+        g = make_game(nnet_args)
+        nnet = alphazero.NNetWrapper(g, nnet_args)
+        coach = alphazero.SelfPlay(g, nnet, nnet_args)
+        np.random.seed(args.seed)
+        start = time.perf_counter()
+        coach.executeEpisodes(1)
+        result[f"cache={cache_size}_sec"] = time.perf_counter() - start
+        if nnet.cache is not None:
+            result.update(nnet.cache.stats())
+    return result
+
+
+def bench_keys(args):
+    """Per-node MCTS table key: hashed stringRepresentation vs incremental Zobrist"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+
+    calls = []
+    for b, _ in random_positions(g, args.num_games, rng):
+        if g.getGameEnded(b, 1) is not None:
+            continue
+        a = int(rng.choice(np.flatnonzero(g.getValidMoves(b, 1))))
+        nb, p = g.getNextState(b, 1, a)
+        nb = g.getCanonicalForm(nb, p)
+        keys = g.getZobristKeys(b)
+        assert g.getNextZobristKeys(keys, a) == g.getZobristKeys(nb)
+        calls.append((nb, keys, a))
+
+    string_us = time_per_call(lambda nb, keys, a: hash(g.stringRepresentation(nb)), calls)
+    zobrist_us = time_per_call(lambda nb, keys, a: hash(g.getNextZobristKeys(keys, a)[0]), calls)
+    nb, keys, a = calls[0]
+    return {
+        "positions": len(calls),
+        "string_us": string_us,
+        "zobrist_us": zobrist_us,
+        "speedup": string_us / zobrist_us,
+        "string_key_bytes": sys.getsizeof(g.stringRepresentation(nb)),
+        "zobrist_key_bytes": sys.getsizeof(keys[0]),
+    }
+
+
+class UniformNNet:
+    """Evaluator with a uniform policy and a zero value, to time the tree alone"""
+
+    def __init__(self, g):
+        self.pi = np.full(g.getActionSize(), 1.0 / g.getActionSize(), dtype=np.float32)
+
+    def predict(self, board):
+        return self.pi, np.zeros(1, dtype=np.float32)
+
+    def predict_batch(self, boards):
+        return np.tile(self.pi, (len(boards), 1)), np.zeros(len(boards), dtype=np.float32)
+
+
+class RecursiveMCTS(alphazero.MCTS):
+    """
+    Reference MCTS.search that recurses and builds a new canonical board per
+    level with getNextState and getCanonicalForm, and selects with np.where,
+    as the search did before the in-place make/unmake loop.
+    """
+
+    def select(self, node):
+        u = node.Q() + self.args.cpuct * node.P * math.sqrt(node.Ns) / (1 + node.N)
+        return int(np.argmax(np.where(node.valids, u, -np.inf)))
+
+    def search(self, canonicalBoard, keys=None, last_action=None):
+        if keys is None:
+            keys = self.game.getZobristKeys(canonicalBoard)
+        s = keys[0]
+
+        if s not in self.Es:
+            self.Es[s] = self.game.getGameEnded(canonicalBoard, 1, last_action)
+        if self.Es[s] is not None:
+            return self.Es[s]
+
+        node = self.nodes.get(s)
+        if node is None:
+            ps, v = self.nnet.predict(canonicalBoard)
+            self.expand(s, canonicalBoard, ps)
+            return v.item()
+
+        a = self.select(node)
+        next_s, next_player = self.game.getNextState(canonicalBoard, 1, a)
+        next_s = self.game.getCanonicalForm(next_s, next_player)
+        next_keys = self.game.getNextZobristKeys(keys, a)
+        node.children[a] = next_keys[0]
+
+        v = -self.search(next_s, next_keys, a)
+
+        node.W[a] += v
+        node.N[a] += 1
+        node.Ns += 1
+        return v
+
+
+def bench_search_loop(args):
+    """MCTS sims/sec of the current search vs the recursive one it replaced"""
+    torch.manual_seed(args.seed)
+    nnet_args = make_args(args, numMCTSSims=args.num_sims, mcts_batch_size=1)
+    g = make_game(nnet_args)
+    nnet = alphazero.NNetWrapper(g, nnet_args)
+
+    rng = np.random.default_rng(args.seed)
+    board, player = g.getInitBoard(), 1
+    for a in rng.choice(g.getActionSize(), 6, replace=False):
+        board, player = g.getNextState(board, player, a)
+    board = g.getCanonicalForm(board, player)
+
+    result = {}
+    for evaluator, net in [("nnet", nnet), ("uniform", UniformNNet(g))]:
+        counts, best = {}, {}
+        # best of repeat runs, alternating the two so that both see the same load
+        for _ in range(args.repeat):
+            for name, cls in [("recursive", RecursiveMCTS), ("iterative", alphazero.MCTS)]:
+                mcts = cls(g, net, nnet_args)
+                start = time.perf_counter()
+                counts[name] = mcts.getActionProb(board, temp=1)
+                best[name] = min(best.get(name, float("inf")), time.perf_counter() - start)
+        for name, seconds in best.items():
+            result[f"{evaluator}_{name}_sims_per_sec"] = args.num_sims / seconds
+        assert np.array_equal(counts["recursive"], counts["iterative"])
+        result[f"{evaluator}_speedup"] = (
+            result[f"{evaluator}_iterative_sims_per_sec"]
+            / result[f"{evaluator}_recursive_sims_per_sec"]
+        )
+    return result
+
+
+def selfplay_examples(g, num_games, rng):
+    """Examples shaped like SelfPlay.executeEpisode output, with random policies"""
+    examples = []
+    for b, _ in random_positions(g, num_games, rng):
+        pi = rng.dirichlet(np.ones(g.getActionSize()))
+        v = float(rng.choice([-1, 1]))
+        examples += [(sb, sp, v) for sb, sp in g.getSymmetries(np.asarray(b), pi)]
+    return examples
+
+
+def bench_replay(args):
+    """Replay storage: list of tuples vs ReplayBuffer vs DiskReplayBuffer memory, history prep and batch assembly"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+
+    # the examples are created inside tracemalloc so the list storage is counted
+    tracemalloc.start()
+    examples = selfplay_examples(g, args.num_games, rng)
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    buffer = replay.ReplayBuffer(args.board_size, len(examples), 1)
+    buffer.add_iteration(examples)
+
+    start = time.perf_counter()
+    flat = list(examples)
+    random.shuffle(flat)
+    shuffle_ms = (time.perf_counter() - start) * 1000
+
+    def list_batch():
+        sample_ids = np.random.randint(len(flat), size=args.batch_size)
+        boards, pis, vs = list(zip(*[flat[i] for i in sample_ids]))
+        return np.array(boards).astype(np.float32), np.array(pis), np.array(vs).astype(np.float32)
+
+    list_us = time_per_call(list_batch, [()] * 100)
+    buffer_us = time_per_call(lambda: buffer.sample(args.batch_size), [()] * 100)
+    # one stored example per position, a random symmetry applied per batch
+    lazy = replay.ReplayBuffer(args.board_size, len(examples) // 8, 1)
+    lazy.add_iteration(examples[::8])
+    lazy_us = time_per_call(lambda: g.getBatchSymmetries(*lazy.sample(args.batch_size)[:2]), [()] * 100)
+
+    with tempfile.TemporaryDirectory() as folder:
+        disk = replay.DiskReplayBuffer(folder, args.board_size, 4)
+        chunk = len(examples) // 4
+        for i in range(4):
+            disk.add_iteration(examples[i * chunk : (i + 1) * chunk])
+        start = time.perf_counter()
+        disk = replay.DiskReplayBuffer(folder, args.board_size, 4)
+        reopen_ms = (time.perf_counter() - start) * 1000
+        disk_us = time_per_call(lambda: disk.sample(args.batch_size), [()] * 100)
+        del disk
+
+    return {
+        "examples": len(examples),
+        "list_bytes_per_example": list_bytes / len(examples),
+        "buffer_bytes_per_example": buffer.nbytes_per_example(),
+        "memory_ratio": list_bytes / len(examples) / buffer.nbytes_per_example(),
+        "list_flatten_shuffle_ms": shuffle_ms,
+        "list_batch_us": list_us,
+        "buffer_batch_us": buffer_us,
+        "lazy_symmetries_bytes": lazy.nbytes_per_example() * len(lazy),
+        "stored_symmetries_bytes": buffer.nbytes_per_example() * len(buffer),
+        "lazy_symmetries_batch_us": lazy_us,
+        "disk_reopen_ms": reopen_ms,
+        "disk_batch_us": disk_us,
+    }
+
+
+def bench_train(args):
+    """NNetWrapper.train data and compute time per step, with and without the prefetch thread"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    examples = selfplay_examples(g, args.num_games, rng)
+    buffer = replay.ReplayBuffer(args.board_size, len(examples), 1)
+    buffer.add_iteration(examples)
+
+    results = {"examples": len(examples)}
+    for prefetch in (0, 2):
+        nnet_args = make_args(args, epochs=1, batch_size=args.batch_size, prefetch_batches=prefetch)
+        nnet = alphazero.NNetWrapper(g, nnet_args)
+        start = time.perf_counter()
+        nnet.train(buffer)
+        results[f"prefetch{prefetch}_epoch_s"] = time.perf_counter() - start
+        results[f"prefetch{prefetch}_data_ms"] = nnet.train_stats["data_ms"]
+        results[f"prefetch{prefetch}_compute_ms"] = nnet.train_stats["compute_ms"]
+    return results
+
+
+EXECUTION_MODES = {
+    "float32": {},
+    "bfloat16": {"precision": "bfloat16"},
+    "channels_last": {"channels_last": True},
+    "compile": {"compile": True},
+    "bfloat16+channels_last+compile": {"precision": "bfloat16", "channels_last": True, "compile": True},
+}
+
+
+def bench_modes(args):
+    """Network positions/sec per execution mode and batch size, and the deviation from float32"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    boards = rng.integers(-1, 2, size=(max(args.batch_sizes), args.board_size, args.board_size)).astype(np.float32)
+
+    results = {}
+    for name, overrides in EXECUTION_MODES.items():
+        torch.manual_seed(args.seed)
+        nnet = alphazero.NNetWrapper(g, make_args(args, **overrides))
+        pi_diff, v_diff = nnet.check_execution_mode()
+        results[f"{name}_max_pi_diff"] = pi_diff
+        results[f"{name}_max_v_diff"] = v_diff
+        for k in args.batch_sizes:
+            batch = list(boards[:k])
+            nnet._predict_batch(batch)  # warm up, compiles on first use
+            us = time_per_call(lambda: nnet._predict_batch(batch), [()] * 20)
+            results[f"{name}_batch{k}_pos_per_s"] = k / (us / 1e6)
+    return results
+
+
+def bench_networks(args):
+    """cnn vs resnet: parameters, checkpoint size, positions/sec and loading across board sizes"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    boards = rng.integers(-1, 2, size=(32, args.board_size, args.board_size)).astype(np.float32)
+    configs = {
+        "cnn": make_args(args, architecture="cnn"),
+        "resnet": make_args(args, architecture="resnet", num_channels=args.resnet_channels, num_blocks=args.num_blocks),
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name, nnet_args in configs.items():
+            nnet = alphazero.NNetWrapper(g, nnet_args)
+            nnet.save_checkpoint(folder, f"{name}.pth.tar")
+            results[f"{name}_params"] = sum(p.numel() for p in nnet.nnet.parameters())
+            results[f"{name}_checkpoint_mb"] = os.path.getsize(os.path.join(folder, f"{name}.pth.tar")) / 2**20
+            for k in (1, 32):
+                batch = list(boards[:k])
+                us = time_per_call(lambda: nnet._predict_batch(batch), [()] * 20)
+                results[f"{name}_batch{k}_pos_per_s"] = k / (us / 1e6)
+
+        # the resnet weights of this board size run unchanged on another one
+        other = 9 if args.board_size != 9 else 15
+        nnet = alphazero.NNetWrapper(game.GomokuGame(other), configs["resnet"])
+        nnet.load_checkpoint(folder, "resnet.pth.tar")
+        pi, _ = nnet.predict(np.zeros((other, other)))
+        results[f"resnet_runs_on_{other}x{other}"] = len(pi) == other * other
+    return results
+
+
+def bench_export(args):
+    """Float checkpoint vs TorchScript export (float and int8): MCTS latency per move and agreement"""
+    rng = np.random.default_rng(args.seed)
+    nnet_args = make_args(args, numMCTSSims=args.num_sims)
+    g = game.GomokuGame(args.board_size)
+    nnet = alphazero.NNetWrapper(g, nnet_args)
+    if args.ckpt:
+        nnet.load_checkpoint(*os.path.split(args.ckpt))
+    positions = [np.asarray(b) for b, _ in random_positions(g, args.num_games, rng)]
+    # about 10 positions to search, skipping finished games
+    moves = [b for b in positions[:: max(1, len(positions) // 10)] if g.getGameEnded(b, 1) is None]
+
+    nnets = {"float": nnet}
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name, quantize in (("script", False), ("int8", True)):
+            path = nnet.export(folder, f"{name}.pt", quantize=quantize)
+            results[f"{name}_file_mb"] = os.path.getsize(path) / 2**20
+            nnets[name] = alphazero.ScriptedNNet(g, path)
+            for k, v in nnets[name].agreement(nnet, positions).items():
+                results[f"{name}_{k}"] = v
+
+        chosen = {}
+        for name, net in nnets.items():
+            # the same tie-breaks for every model, so that only their outputs differ
+            np.random.seed(args.seed)
+            start = time.perf_counter()
+            chosen[name] = [
+                np.argmax(alphazero.MCTS(g, net, nnet_args).getActionProb(b, temp=0)) for b in moves
+            ]
+            results[f"{name}_ms_per_move"] = (time.perf_counter() - start) * 1000 / len(moves)
+        for name in ("script", "int8"):
+            results[f"{name}_same_mcts_move"] = float(np.mean(np.array(chosen[name]) == np.array(chosen["float"])))
+    return results
+
+
+def legacy_predict(nnet, board):
+    """NNetWrapper.predict before the PredictHandle, kept as the reference"""
+    board = torch.FloatTensor(np.asarray(board, dtype=np.float32))
+    board = board.view(1, nnet.board_x, nnet.board_y)
+    nnet.nnet.eval()
+    with torch.no_grad():
+        pi, v = nnet.nnet(board)
+    return torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0]
+
+
+def bench_predict(args):
+    """Per-call time of single-position predict, old path vs PredictHandle"""
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    boards = [np.asarray(b) for b, _ in random_positions(g, 2, rng)][:100]
+
+    results = {}
+    # a 1-channel network shows the per-call overhead, num_channels the end-to-end effect
+    for channels in (1, args.num_channels):
+        nnet = alphazero.NNetWrapper(g, make_args(args, num_channels=channels))
+        legacy_us = time_per_call(lambda b: legacy_predict(nnet, b), [(b,) for b in boards])
+        handle_us = time_per_call(nnet.handle.predict, [(b,) for b in boards])
+        results[f"channels{channels}_legacy_us"] = legacy_us
+        results[f"channels{channels}_handle_us"] = handle_us
+        results[f"channels{channels}_saved_us"] = legacy_us - handle_us
+    return results
+
+
+def bench_sprt(args):
+    """Simulated gating: mean games and accept rate of the SPRT vs all arena_compare games"""
+    rng = np.random.default_rng(args.seed)
+    nnet_args = make_args(args)
+    threshold, margin = nnet_args.updateThreshold, nnet_args.sprt_margin
+    num = nnet_args.arenaCompare // 2 * 2
+
+    results = {"arena_compare": num}
+    for p in (0.3, 0.45, 0.55, 0.65, 0.8):
+        games, sprt_accepts, full_accepts = [], 0, 0
+        for _ in range(args.num_trials):
+            # wins of the new model, draws do not count for either rule
+            wins = rng.random(num) < p
+            full_accepts += wins.mean() >= threshold
+            sprt = game.SPRT(threshold - margin, threshold + margin, nnet_args.sprt_alpha, nnet_args.sprt_beta)
+            for j, won in enumerate(wins):
+                sprt.update(1 if won else -1)
+                if j % 2 == 1 and sprt.decision() is not None:
+                    break
+            decision = sprt.decision()
+            sprt_accepts += decision == "accept" or decision is None and wins[: sprt.games].mean() >= threshold
+            games.append(sprt.games)
+        results[f"p{p}_sprt_games"] = float(np.mean(games))
+        results[f"p{p}_sprt_accept_rate"] = sprt_accepts / args.num_trials
+        results[f"p{p}_full_accept_rate"] = full_accepts / args.num_trials
+    return results
+
+
+def bench_primitives(args):
+    """Per-call time of the GomokuGame primitives for both backends"""
+    result = {}
+    for backend, cls in [("array", game.GomokuGame), ("bitboard", game.BitBoardGomokuGame)]:
+        g = cls(args.board_size)
+        rng = np.random.default_rng(args.seed)
+        positions = random_positions(g, args.num_games, rng)
+        ongoing = [b for b, a in positions if g.getGameEnded(b, 1, a) is None]
+        moves = [(b, rng.choice(np.flatnonzero(g.getValidMoves(b, 1)))) for b in ongoing]
+        pi = np.full(g.getActionSize(), 1.0 / g.getActionSize())
+
+        calls = {
+            "getGameEnded": (g.getGameEnded, [(b, 1, a) for b, a in positions]),
+            "getValidMoves": (g.getValidMoves, [(b, 1) for b in ongoing]),
+            "getNextState": (g.getNextState, [(b, 1, a) for b, a in moves]),
+            "getSymmetries": (g.getSymmetries, [(b, pi) for b in ongoing[:200]]),
+        }
+        for name, (fn, args_list) in calls.items():
+            result[f"{backend}_{name}_us"] = time_per_call(fn, args_list, repeat=args.repeat)
+    return result
+
+
+def bench_mcts(args):
+    """
+    MCTS.getActionProb sims/sec with the network and with a uniform
+    evaluator, the median of --repeat searches on a new tree
+    """
+    torch.manual_seed(args.seed)
+    nnet_args = make_args(args, numMCTSSims=args.num_sims)
+    g = make_game(nnet_args)
+    rng = np.random.default_rng(args.seed)
+    board, player = g.getInitBoard(), 1
+    for a in rng.choice(g.getActionSize(), 6, replace=False):
+        board, player = g.getNextState(board, player, a)
+    board = g.getCanonicalForm(board, player)
+
+    result = {}
+    for evaluator, net in [("nnet", alphazero.NNetWrapper(g, nnet_args)), ("uniform", UniformNNet(g))]:
+        seconds = []
+        for _ in range(args.repeat):
+            np.random.seed(args.seed)
+            mcts = alphazero.MCTS(g, net, nnet_args)
+            start = time.perf_counter()
+            mcts.getActionProb(board, temp=1)
+            seconds.append(time.perf_counter() - start)
+        result[f"{evaluator}_sims_per_s"] = args.num_sims / float(np.median(seconds))
+    return result
+
+
+def bench_inference(args):
+    """predict latency and predict_batch positions/sec by batch size"""
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    nnet = alphazero.NNetWrapper(g, make_args(args))
+    positions = [np.asarray(b) for b, _ in random_positions(g, 2, rng)]
+    boards = [positions[i % len(positions)] for i in range(max(args.batch_sizes))]
+
+    result = {"predict_us": time_per_call(nnet.predict, [(b,) for b in positions[:100]], repeat=args.repeat)}
+    for k in args.batch_sizes:
+        us = time_per_call(nnet.predict_batch, [(boards[:k],)] * 10, repeat=args.repeat)
+        result[f"batch{k}_pos_per_s"] = k / (us / 1e6)
+    return result
+
+
+def bench_training(args):
+    """NNetWrapper.train optimizer steps/sec"""
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    g = game.GomokuGame(args.board_size)
+    examples = selfplay_examples(g, 2, rng)
+    # exactly train_steps batches in one epoch
+    size = args.train_steps * args.batch_size
+    buffer = replay.ReplayBuffer(args.board_size, size, 1)
+    buffer.add_iteration([examples[i % len(examples)] for i in range(size)])
+
+    nnet = alphazero.NNetWrapper(g, make_args(args, epochs=1, batch_size=args.batch_size))
+    start = time.perf_counter()
+    nnet.train(buffer)
+    return {"steps_per_s": args.train_steps / (time.perf_counter() - start)}
+
+
+def bench_gumbel(args):
+    """
+    Search quality at 16-64 simulations: on random positions with a winning
+    move, the policy target's mass on winning moves and how often the move
+    played wins, for PUCT visit counts and Gumbel sequential halving with
+    16 and with 64 (the default) candidates. The evaluator is uniform so
+    only the root search differs.
+    """
+    rng = np.random.default_rng(args.seed)
+    nnet_args = make_args(args)
+    g = make_game(nnet_args)
+    net = UniformNNet(g)
+
+    positions = []
+    for board, action in random_positions(g, args.num_games, rng):
+        if g.getGameEnded(board, 1, action) is not None:
+            continue
+        wins = [
+            a for a in np.flatnonzero(g.getValidMoves(board, 1))
+            if g.getGameEnded(g.getNextState(board, 1, a)[0], 1, a) == 1
+        ]
+        if wins:
+            positions.append((board, wins))
+
+    results = {"positions": len(positions)}
+    for mode, num_actions in (("puct", 0), ("gumbel", 16), ("gumbel", 64)):
+        if num_actions:
+            mode = f"gumbel{num_actions}"
+        for sims in (16, 32, 64):
+            nnet_args.update(search_mode=mode[:6], gumbel_num_actions=num_actions, numMCTSSims=sims)
+            np.random.seed(args.seed)
+            mass, found, used = 0.0, 0, 0
+            start = time.perf_counter()
+            for board, wins in positions:
+                mcts = alphazero.MCTS(g, net, nnet_args)
+                pi = mcts.getActionProb(board, temp=1)
+                move = mcts.selected_action if num_actions else int(np.argmax(pi))
+                mass += pi[wins].sum()
+                found += move in wins
+                used += mcts.num_sims
+            results[f"{mode}_sims{sims}_win_mass"] = mass / max(len(positions), 1)
+            results[f"{mode}_sims{sims}_win_found"] = found / max(len(positions), 1)
+            # both searches must stay within the same budget for a fair comparison
+            results[f"{mode}_sims{sims}_sims_used"] = used / max(len(positions), 1)
+            results[f"{mode}_sims{sims}_ms_per_move"] = (time.perf_counter() - start) / max(len(positions), 1) * 1000
+    return results
+
+
+def bench_vector_game(args):
+    """
+    VectorGomokuGame vs a loop of GomokuGame on batch_size random games:
+    moves/sec of each, and how many game ends of the two disagree
+    """
+    rng = np.random.default_rng(args.seed)
+    num_envs, num_steps = args.batch_size, 4 * args.board_size**2
+    venv = game.VectorGomokuGame(num_envs, args.board_size)
+    g = game.GomokuGame(args.board_size)
+
+    # random valid actions, drawn ahead so that neither timing includes them
+    actions, ends, mismatches = [], [], 0
+    boards = [g.getInitBoard() for _ in range(num_envs)]
+    players = [1] * num_envs
+    for _ in range(num_steps):
+        a = np.argmax(rng.random((num_envs, g.getActionSize())) * venv.getValidMoves(), axis=1)
+        results, dones = venv.step(a)
+        actions.append(a)
+        ends.append((results, dones))
+        for i in range(num_envs):
+            boards[i], players[i] = g.getNextState(boards[i], players[i], a[i])
+            r = g.getGameEnded(boards[i], -players[i], a[i])
+            mismatches += (r is not None) != dones[i] or dones[i] and r != results[i]
+            if r is not None:
+                boards[i], players[i] = g.getInitBoard(), 1
+
+    venv.reset()
+    start = time.perf_counter()
+    for a in actions:
+        venv.getValidMoves()
+        venv.step(a)
+    vector_seconds = time.perf_counter() - start
+
+    boards = [g.getInitBoard() for _ in range(num_envs)]
+    players = [1] * num_envs
+    start = time.perf_counter()
+    for a in actions:
+        for i in range(num_envs):
+            g.getValidMoves(boards[i], players[i])
+            boards[i], players[i] = g.getNextState(boards[i], players[i], a[i])
+            if g.getGameEnded(boards[i], players[i], a[i]) is not None:
+                boards[i], players[i] = g.getInitBoard(), 1
+    loop_seconds = time.perf_counter() - start
+
+    moves = num_envs * num_steps
+    return {
+        "games_ended": int(sum(d.sum() for _, d in ends)),
+        "mismatches": int(mismatches),
+        "vector_moves_per_sec": moves / vector_seconds,
+        "loop_moves_per_sec": moves / loop_seconds,
+        "speedup": loop_seconds / vector_seconds,
+    }
+
+
+def lower_is_better(metric):
+    """True for times, False for rates, None for metrics that are not compared"""
+    if metric.endswith(("_per_s", "_per_sec", "speedup")):
+        return False
+    if metric.endswith(("_us", "_ms", "_s")):
+        return True
+    return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints every timed metric next to its baseline value.
+
+    Returns the (benchmark, metric, change) of those that got worse by more
+    than tolerance, a relative change.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            direction = lower_is_better(metric)
+            old = baseline.get(name, {}).get(metric)
+            if direction is None or not old or not isinstance(value, (int, float)):
+                continue
+            change = (value - old) / old
+            worse = change > tolerance if direction else change < -tolerance
+            print(f"  {name}/{metric}: {old:.4g} -> {value:.4g} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append((name, metric, change))
+    return regressions
+
+
+SUITE = ["primitives", "mcts", "inference", "training"]
+
+
+BENCHMARKS = {
+    "game_ended": bench_game_ended,
+    "backends": bench_backends,
+    "mcts_batch": bench_mcts_batch,
+    "selfplay": bench_selfplay,
+    "playout_cap": bench_playout_cap,
+    "mcts_memory": bench_mcts_memory,
+    "eval_cache": bench_eval_cache,
+    "keys": bench_keys,
+    "search_loop": bench_search_loop,
+    "replay": bench_replay,
+    "train": bench_train,
+    "modes": bench_modes,
+    "networks": bench_networks,
+    "export": bench_export,
+    "predict": bench_predict,
+    "sprt": bench_sprt,
+    "gumbel": bench_gumbel,
+    "vector_game": bench_vector_game,
+    "primitives": bench_primitives,
+    "mcts": bench_mcts,
+    "inference": bench_inference,
+    "training": bench_training,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--board_size", type=int, default=15)
+    parser.add_argument("--num_games", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--num_channels", type=int, default=64)
+    parser.add_argument("--num_sims", type=int, default=400)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--num_episodes", type=int, default=8)
+    parser.add_argument("--worker_counts", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--inference_server", action="store_true")
+    parser.add_argument("--eval_cache_size", type=int, default=100000)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--resnet_channels", type=int, default=128)
+    parser.add_argument("--num_blocks", type=int, default=6)
+    parser.add_argument("--num_trials", type=int, default=2000)
+    parser.add_argument("--ckpt", type=str, default=None, help="checkpoint for the export benchmark, random weights if unset")
+    parser.add_argument("--train_steps", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5, help="suite timings keep the best of this many runs")
+    parser.add_argument("--only", type=str, nargs="*", choices=list(BENCHMARKS))
+    parser.add_argument("--board_sizes", type=int, nargs="+", help="run every benchmark at each of these sizes")
+    parser.add_argument("--suite", action="store_true", help=f"run the regression suite {SUITE}, at sizes 9 and 15 by default")
+    parser.add_argument("--output", type=str, default=None, help="write the results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    names = args.only or (SUITE if args.suite else list(BENCHMARKS))
+    board_sizes = args.board_sizes or ([9, 15] if args.suite else [args.board_size])
+
+    results = {}
+    for board_size in board_sizes:
+        args.board_size = board_size
+        for name in names:
+            result = BENCHMARKS[name](args)
+            results[f"{name}@{board_size}"] = result
+            print(f"=== {name} (board_size={board_size}) ===")
+            for k, v in result.items():
+                if isinstance(v, float):
+                    # small deviations would round to 0.00
+                    v = f"{v:.3g}" if 0 < abs(v) < 0.01 else f"{v:.2f}"
+                print(f"  {k}: {v}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "torch": torch.__version__,
+                        "machine": platform.machine(),
+                        "threads": torch.get_num_threads(),
+                        "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+                default=lambda x: x.item() if hasattr(x, "item") else str(x),
+            )
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print(f"=== compared with {args.baseline} ===")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.tolerance:.0%}")
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
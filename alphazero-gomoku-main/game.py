@@ -1,3 +1,6 @@
+import functools
+import math
+import multiprocessing as mp
 import numpy as np
 import logging
 from tqdm import tqdm
@@ -79,12 +82,131 @@ class Board:
                             return True
         return False
 
+    def is_win_at(self, move):
+        """Check if the stone at move is part of a five in a row
+
+        Only the four lines through move are scanned, so this is the
+        incremental counterpart of is_win for the last placed stone.
+        """
+        x, y = move
+        color = self[x][y]
+        if color == 0:
+            return False
+        directions = [(1, 0), (0, 1), (1, 1), (1, -1)]
+
+        for dx, dy in directions:
+            count = 1
+            # Check forward
+            tx, ty = x + dx, y + dy
+            while 0 <= tx < self.n and 0 <= ty < self.n and self[tx][ty] == color:
+                count += 1
+                tx += dx
+                ty += dy
+            # Check backward
+            tx, ty = x - dx, y - dy
+            while 0 <= tx < self.n and 0 <= ty < self.n and self[tx][ty] == color:
+                count += 1
+                tx -= dx
+                ty -= dy
+            if count >= 5:
+                return True
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def _full_mask(n):
+    """Bitset with every cell of an n x n BitBoard set"""
+    return ((1 << n) - 1) * sum(1 << (x * (n + 1)) for x in range(n))
+
+
+class BitBoard:
+    """
+    Gomoku board stored as one bitset per color
+    Board data:
+    white = bits of the 1 stones, black = bits of the -1 stones
+
+    Cell (x, y) is bit x * (n + 1) + y. The extra column at the end of every
+    row is always empty, so shifting a bitset never carries a line from one
+    row into the next.
+    """
+
+    __slots__ = ("n", "white", "black")
+
+    def __init__(self, n=15, white=0, black=0):
+        self.n = n
+        self.white = white
+        self.black = black
+
+    @classmethod
+    def from_array(cls, board):
+        """Build a BitBoard from an n x n array of 1, -1 and 0"""
+        board = np.asarray(board)
+        n = len(board)
+        white = black = 0
+        for x, y in zip(*np.nonzero(board)):
+            bit = 1 << int(x * (n + 1) + y)
+            if board[x][y] == 1:
+                white |= bit
+            else:
+                black |= bit
+        return cls(n, white, black)
+
+    def _unpack(self, bits):
+        """Convert a bitset to an n x n uint8 array"""
+        n = self.n
+        width = n * (n + 1)
+        raw = np.frombuffer(bits.to_bytes((width + 7) // 8, "little"), dtype=np.uint8)
+        return np.unpackbits(raw, bitorder="little")[:width].reshape(n, n + 1)[:, :n]
+
+    def __array__(self, dtype=None, copy=None):
+        board = self._unpack(self.white).astype(np.int64) - self._unpack(self.black)
+        return board if dtype is None else board.astype(dtype)
+
+    def __mul__(self, player):
+        # player * board is how GomokuGame builds the canonical form
+        if player == 1:
+            return self
+        return BitBoard(self.n, self.black, self.white)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return BitBoard(self.n, self.black, self.white)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        return np.asarray(self)[index]
+
+    def empty(self):
+        """Bitset of the empty cells"""
+        return _full_mask(self.n) & ~(self.white | self.black)
+
+    def legal_moves_mask(self):
+        """Return an n x n uint8 array with 1 on every empty cell"""
+        return self._unpack(self.empty())
+
+    def is_win(self, color):
+        """Check if there is a win, using one shift-and-AND chain per direction"""
+        bits = self.white if color == 1 else self.black
+        # right, down, down-right, down-left
+        for d in (1, self.n + 1, self.n + 2, self.n):
+            m = bits & (bits >> d)
+            m &= m >> (2 * d)
+            if m & (bits >> (4 * d)):
+                return True
+        return False
+
 
 class GomokuGame:
     square_content = {-1: "X", +0: ".", +1: "O"}
 
     def __init__(self, n=15):
         self.n = n
+        # Zobrist table: a fixed random 64-bit number per cell and color (1, -1)
+        rng = np.random.default_rng(0)
+        self.zobrist = rng.integers(0, 2**64, size=(n * n, 2), dtype=np.uint64).tolist()
 
     def getInitBoard(self):
         b = Board(self.n)
@@ -104,6 +226,17 @@ class GomokuGame:
         b.execute_move(move, player)
         return (b.pieces, -player)
 
+    def makeMove(self, board, player, action):
+        """Place player's stone on board in place, the undoable getNextState"""
+        board[action // self.n, action % self.n] = player
+
+    def undoMove(self, board, action):
+        """Take back the stone makeMove placed on board"""
+        board[action // self.n, action % self.n] = 0
+
+    def copyBoard(self, board):
+        return np.copy(board)
+
     def getValidMoves(self, board, player):
         b = Board(self.n)
         b.pieces = np.copy(board)
@@ -114,8 +247,27 @@ class GomokuGame:
             valids[self.n * x + y] = 1
         return np.array(valids)
 
-    def getGameEnded(self, board, player):
+    def getGameEnded(self, board, player, last_action=None):
+        """
+        Returns 1 if player won, -1 if player lost, 0 for a draw and None
+        if the game is not over.
+
+        If last_action is given, only the lines through the last placed
+        stone are checked. This gives the same result as the full scan as
+        long as the position before last_action was not terminal, which
+        holds for every position reached by MCTS, SelfPlay and Arena.
+        """
         b = Board(self.n)
+        if last_action is not None:
+            # read only, so no copy is needed
+            b.pieces = board
+            move = (last_action // self.n, last_action % self.n)
+            if b.is_win_at(move):
+                return 1 if b[move[0]][move[1]] == player else -1
+            if not b.has_legal_moves():
+                return 0
+            return None
+
         b.pieces = np.copy(board)
 
         if b.is_win(player):
@@ -145,8 +297,55 @@ class GomokuGame:
                 symmetries += [(newB, newPi.ravel())]
         return symmetries
 
+    def getBatchSymmetries(self, boards, pis, rng=np.random):
+        """
+        Applies one of the 8 rotations/reflections of getSymmetries, drawn
+        independently for every example, to a batch of boards and policies.
+
+        boards: batch x n x n array, pis: batch x n*n array
+        """
+        pis = pis.reshape(-1, self.n, self.n)
+        ks = rng.randint(8, size=len(boards))
+        newB = np.empty_like(boards)
+        newPi = np.empty_like(pis)
+        for k in range(8):
+            rows = np.flatnonzero(ks == k)
+            if len(rows) == 0:
+                continue
+            b = np.rot90(boards[rows], k % 4, axes=(1, 2))
+            p = np.rot90(pis[rows], k % 4, axes=(1, 2))
+            if k >= 4:
+                b, p = b[:, :, ::-1], p[:, :, ::-1]
+            newB[rows] = b
+            newPi[rows] = p
+        return newB, newPi.reshape(len(boards), -1)
+
     def stringRepresentation(self, board):
-        return board.tostring()
+        return board.tobytes()
+
+    def getZobristKeys(self, board):
+        """
+        Returns (h, h_neg), the Zobrist keys of board and of -board.
+
+        Keeping the key of the flipped board too lets getNextZobristKeys
+        follow a move and the color flip of getCanonicalForm in O(1).
+        """
+        board = np.asarray(board).ravel()
+        h = h_neg = 0
+        for a in np.flatnonzero(board):
+            c = 0 if board[a] == 1 else 1
+            h ^= self.zobrist[a][c]
+            h_neg ^= self.zobrist[a][1 - c]
+        return h, h_neg
+
+    def getNextZobristKeys(self, keys, action):
+        """
+        Returns the keys of getCanonicalForm(getNextState(board, 1, action), -1)
+        from the keys of the canonical board: the new stone is 1, and then
+        every color flips.
+        """
+        h, h_neg = keys
+        return h_neg ^ self.zobrist[action][1], h ^ self.zobrist[action][0]
 
     @staticmethod
     def display(board, player1_first=True):
@@ -157,6 +356,157 @@ class GomokuGame:
         pygame.display.flip()
 
 
+class BitBoardGomokuGame(GomokuGame):
+    """
+    GomokuGame backed by BitBoard instead of numpy arrays.
+
+    getNextState builds a new BitBoard from two ints instead of copying an
+    array, and the canonical form just swaps the two bitsets. makeMove and
+    undoMove set and clear one bit in place. Boards convert to numpy arrays
+    through np.asarray, which is what the network and getSymmetries see.
+    """
+
+    def __init__(self, n=15):
+        super().__init__(n)
+        self.full = _full_mask(n)
+
+    def getInitBoard(self):
+        return BitBoard(self.n)
+
+    def _bit(self, action):
+        # int() so numpy actions do not overflow a fixed-width shift
+        action = int(action)
+        return 1 << (action // self.n * (self.n + 1) + action % self.n)
+
+    def getNextState(self, board, player, action):
+        bit = self._bit(action)
+        if player == 1:
+            return BitBoard(self.n, board.white | bit, board.black), -player
+        return BitBoard(self.n, board.white, board.black | bit), -player
+
+    def makeMove(self, board, player, action):
+        if player == 1:
+            board.white |= self._bit(action)
+        else:
+            board.black |= self._bit(action)
+
+    def undoMove(self, board, action):
+        mask = ~self._bit(action)
+        board.white &= mask
+        board.black &= mask
+
+    def copyBoard(self, board):
+        return BitBoard(board.n, board.white, board.black)
+
+    def getValidMoves(self, board, player):
+        return board.legal_moves_mask().ravel()
+
+    def getGameEnded(self, board, player, last_action=None):
+        if last_action is not None:
+            # only the color of the last stone can have just made five
+            color = 1 if board.white & self._bit(last_action) else -1
+            if board.is_win(color):
+                return 1 if color == player else -1
+        else:
+            if board.is_win(player):
+                return 1
+            if board.is_win(-player):
+                return -1
+        if board.white | board.black == self.full:
+            return 0
+        return None
+
+    def stringRepresentation(self, board):
+        return (board.white, board.black)
+
+
+class VectorGomokuGame:
+    """
+    num_envs Gomoku games stepped together, for batched self-play and
+    evaluation without a Python loop per game.
+
+    boards is a num_envs x n x n int8 array with the GomokuGame conventions
+    (1=white, -1=black, 0=empty, action a is cell (a // n, a % n)) and
+    players holds the player to move in each game, 1 at the start. step()
+    plays one action in every game. A game that ends is reset to the empty
+    board right away if auto_reset, so every game always has a move.
+    """
+
+    def __init__(self, num_envs, n=15, auto_reset=True):
+        self.num_envs = num_envs
+        self.n = n
+        self.auto_reset = auto_reset
+        self.boards = np.zeros((num_envs, n, n), dtype=np.int8)
+        self.players = np.ones(num_envs, dtype=np.int8)
+        self.moves = np.zeros(num_envs, dtype=np.int32)  # stones on each board
+
+    def getBoardSize(self):
+        return (self.n, self.n)
+
+    def getActionSize(self):
+        return self.n * self.n
+
+    def reset(self, envs=None):
+        """Clear the games envs (a mask or indices), all of them by default"""
+        if envs is None:
+            envs = slice(None)
+        self.boards[envs] = 0
+        self.players[envs] = 1
+        self.moves[envs] = 0
+
+    def getValidMoves(self):
+        """num_envs x action_size boolean mask of the empty cells"""
+        return self.boards.reshape(self.num_envs, -1) == 0
+
+    def getCanonicalBoards(self):
+        """Every board from the point of view of its player to move"""
+        return self.boards * self.players[:, None, None]
+
+    def _fives(self, stones):
+        """Whether each of the num_envs 0/1 boards stones holds five in a row"""
+        n = self.n
+        m = n - 4
+        if m <= 0:
+            return np.zeros(self.num_envs, dtype=bool)
+        # shifted sums of 5 consecutive cells along each direction
+        rows = sum(stones[:, :, k : m + k] for k in range(5))
+        cols = sum(stones[:, k : m + k, :] for k in range(5))
+        diag = sum(stones[:, k : m + k, k : m + k] for k in range(5))
+        anti = sum(stones[:, k : m + k, 4 - k : n - k] for k in range(5))
+        return (
+            (rows == 5).any(axis=(1, 2))
+            | (cols == 5).any(axis=(1, 2))
+            | (diag == 5).any(axis=(1, 2))
+            | (anti == 5).any(axis=(1, 2))
+        )
+
+    def step(self, actions):
+        """
+        Plays actions[i] for the player to move in game i.
+
+        Returns:
+            results: int8 array, 1 where the move won, 0 otherwise (a draw
+                     or a game that goes on)
+            dones: bool array of the games that ended with this move, which
+                   are already reset if auto_reset
+        """
+        actions = np.asarray(actions)
+        envs = np.arange(self.num_envs)
+        x, y = actions // self.n, actions % self.n
+        if (self.boards[envs, x, y] != 0).any():
+            raise ValueError("Move on an occupied cell")
+        self.boards[envs, x, y] = self.players
+        self.moves += 1
+
+        # only the mover can have just made five
+        wins = self._fives((self.boards == self.players[:, None, None]).view(np.uint8))
+        dones = wins | (self.moves == self.n * self.n)
+        self.players = -self.players
+        if self.auto_reset and dones.any():
+            self.reset(dones)
+        return wins.astype(np.int8), dones
+
+
 class GomokuGUI:
     def __init__(self, board_size, player1_first=True):
         pygame.init()
@@ -211,6 +561,7 @@ class GomokuGUI:
         return None
 
     def draw_board(self, board, player1_first=True):
+        board = np.asarray(board)
         # Fill background
         self.screen.fill(self.BROWN)
         
@@ -343,6 +694,40 @@ class HumanGomokuPlayer:
             pygame.display.flip()
 
 
+class SPRT:
+    """
+    Sequential probability ratio test on the win rate p of a player,
+    between H0: p = p0 and H1: p = p1 with p0 < p1, at false acceptance
+    rate alpha and false rejection rate beta. Draws carry no information
+    about p and are ignored.
+    """
+
+    def __init__(self, p0, p1, alpha=0.05, beta=0.05):
+        self.p0, self.p1 = p0, p1
+        self.win = math.log(p1 / p0)
+        self.loss = math.log((1 - p1) / (1 - p0))
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.llr = 0.0  # log likelihood ratio of H1 over H0
+        self.games = 0
+
+    def update(self, result):
+        """result: 1 if the tested player won, -1 if it lost, anything else for a draw"""
+        self.games += 1
+        if result == 1:
+            self.llr += self.win
+        elif result == -1:
+            self.llr += self.loss
+
+    def decision(self):
+        """Returns "accept" (H1), "reject" (H0), or None while undecided"""
+        if self.llr >= self.upper:
+            return "accept"
+        if self.llr <= self.lower:
+            return "reject"
+        return None
+
+
 class Arena:
     """
     An Arena class where any 2 agents can be pit against each other.
@@ -382,7 +767,8 @@ class Arena:
             self.game.gui = GomokuGUI(len(board), self.player1_first)
         
         it = 0
-        while self.game.getGameEnded(board, curPlayer) is None:
+        action = None
+        while self.game.getGameEnded(board, curPlayer, action) is None:
             it += 1
             if verbose:
                 assert self.display
@@ -403,14 +789,15 @@ class Arena:
                 assert valids[action] > 0
             
             board, curPlayer = self.game.getNextState(board, curPlayer, action)
-        
+
+        ended = self.game.getGameEnded(board, curPlayer, action)
         if verbose:
             assert self.display
             print("Game over: Turn ", str(it), "Result ", str(curPlayer))
             self.display(board, self.player1_first)  # Pass player order information
             
             if hasattr(self.game, 'gui'):
-                result = curPlayer * self.game.getGameEnded(board, curPlayer)
+                result = curPlayer * ended
                 if not self.player1_first:
                     result = -result
                 
@@ -427,21 +814,25 @@ class Arena:
                             pygame.quit()
                             sys.exit()
                     
-                    action = self.game.gui.handle_game_over_input()
-                    if action == "next" and not is_final_round:
+                    choice = self.game.gui.handle_game_over_input()
+                    if choice == "next" and not is_final_round:
                         break
-                    elif action == "quit":
+                    elif choice == "quit":
                         pygame.quit()
                         sys.exit()
                     
                     pygame.display.flip()
         
-        return curPlayer * self.game.getGameEnded(board, curPlayer)
+        return curPlayer * ended
 
-    def playGames(self, num, verbose=False):
+    def playGames(self, num, verbose=False, sprt=None):
         """
         Plays num games in which player1 starts num/2 games and player2 starts num/2 games.
 
+        sprt: an SPRT on the win rate of player2. The games then alternate
+              who goes first, and play stops after the first pair of games
+              at which the test is decided.
+
         Returns:
             oneWon: games won by player1
             twoWon: games won by player2
@@ -449,6 +840,8 @@ class Arena:
         """
         self.total_rounds = num
         self.current_round = 0
+        if sprt is not None:
+            return self._playGamesSPRT(int(num / 2), sprt, verbose)
         num = int(num / 2)
         oneWon = 0
         twoWon = 0
@@ -477,3 +870,138 @@ class Arena:
                 draws += 1
 
         return oneWon, twoWon, draws
+
+    def _playGamesSPRT(self, pairs, sprt, verbose=False):
+        player1, player2 = self.player1, self.player2
+        oneWon = 0
+        twoWon = 0
+        draws = 0
+        t = tqdm(range(2 * pairs), desc="Arena.playGames (SPRT)")
+        for j in t:
+            # player1 goes first in even games, player2 in odd ones
+            self.player1_first = j % 2 == 0
+            if self.player1_first:
+                self.player1, self.player2 = player1, player2
+                gameResult = self.playGame(verbose=verbose)
+            else:
+                self.player1, self.player2 = player2, player1
+                gameResult = -self.playGame(verbose=verbose)
+            if gameResult == 1:
+                oneWon += 1
+            elif gameResult == -1:
+                twoWon += 1
+            else:
+                draws += 1
+            sprt.update(-gameResult)
+            if j % 2 == 1 and sprt.decision() is not None:
+                break
+        t.close()
+        self.player1, self.player2 = player1, player2
+        _log_sprt(sprt, 2 * pairs)
+        return oneWon, twoWon, draws
+
+    def playGamesParallel(self, num, num_workers, make_players, seed=0, sprt=None):
+        """
+        Plays the games of playGames on a pool of num_workers processes, with
+        the same split of who goes first and the same result counts.
+
+        make_players is a picklable callable returning fresh (player1,
+        player2) play functions. Every worker calls it once per game, so
+        each game gets its own players, e.g. new MCTS trees. Game j is
+        seeded from (seed, j), so the results do not depend on which worker
+        plays it.
+
+        sprt: an SPRT on the win rate of player2, as in playGames. The games
+              alternate who goes first, results are taken in game order, and
+              the remaining games are cancelled once the test is decided.
+
+        Returns:
+            oneWon: games won by player1
+            twoWon: games won by player2
+            draws:  games won by nobody
+        """
+        num = int(num / 2)
+        tasks = [
+            (
+                np.random.SeedSequence([seed, j]).generate_state(1)[0],
+                j < num if sprt is None else j % 2 == 0,
+            )
+            for j in range(2 * num)
+        ]
+        oneWon = 0
+        twoWon = 0
+        draws = 0
+
+        with worker_pool(num_workers, _init_arena_worker, self.game, make_players) as pool:
+            results = pool.imap_unordered(_play_arena_game, tasks) if sprt is None else pool.imap(_play_arena_game, tasks)
+            t = tqdm(results, total=len(tasks), desc=f"Arena.playGames ({num_workers} workers)")
+            for j, gameResult in enumerate(t):
+                if gameResult == 1:
+                    oneWon += 1
+                elif gameResult == -1:
+                    twoWon += 1
+                else:
+                    draws += 1
+                if sprt is not None:
+                    sprt.update(-gameResult)
+                    if j % 2 == 1 and sprt.decision() is not None:
+                        # leaving the pool terminates the games still running
+                        break
+            t.close()
+
+        if sprt is not None:
+            _log_sprt(sprt, len(tasks))
+        return oneWon, twoWon, draws
+
+
+def _log_sprt(sprt, num):
+    decision = sprt.decision()
+    if decision is None:
+        log.info(f"SPRT undecided after all {num} games, llr {sprt.llr:.2f}")
+    else:
+        log.info(f"SPRT {decision}s after {sprt.games} games, {num - sprt.games} of {num} games saved")
+
+
+def worker_context():
+    """Multiprocessing context of the self-play and arena worker pools"""
+    # spawn rather than fork, torch's thread pools do not survive a fork
+    return mp.get_context("spawn")
+
+
+def worker_pool(num_workers, setup, *args, ctx=None):
+    """
+    Returns a Pool of num_workers processes from ctx (default
+    worker_context()). Each worker calls setup(*args) once, and its tasks
+    get the result from worker_state().
+    """
+    if ctx is None:
+        ctx = worker_context()
+    return ctx.Pool(num_workers, initializer=_init_worker, initargs=(setup, args))
+
+
+# per-process state of a worker_pool
+_worker = {}
+
+
+def _init_worker(setup, args):
+    _worker["state"] = setup(*args)
+
+
+def worker_state():
+    """The result of setup in this worker of a worker_pool"""
+    return _worker["state"]
+
+
+def _init_arena_worker(game, make_players):
+    return game, make_players
+
+
+def _play_arena_game(task):
+    """Plays one game, returns the result for player1 (1 won, -1 lost, else draw)"""
+    seed, player1_first = task
+    np.random.seed(seed)
+    game, make_players = worker_state()
+    player1, player2 = make_players()
+    if player1_first:
+        return Arena(player1, player2, game).playGame()
+    return -Arena(player2, player1, game).playGame()
@@ -0,0 +1,251 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+_NO_CARRY = object()  # no request held over, distinct from the None stop request
+
+
+class InferenceServer:
+    """
+    Owns the one NNetWrapper and serves predictions to self-play workers.
+
+    Every client gets a slot of rows in two shared-memory arrays, one for the
+    boards it submits and one for the policies and values it gets back. A
+    client writes its boards into its slot and puts (client_id, rows,
+    submit_time) on the request queue. The server thread groups requests into
+    a batch until max_batch rows are collected or max_wait_ms have passed
+    since the first one, runs a single predict_batch, writes the results back
+    and releases each client's semaphore.
+    """
+
+    def __init__(self, nnet, ctx, num_clients, rows_per_client=1, max_batch=64, max_wait_ms=2.0):
+        self.nnet = nnet
+        self.num_clients = num_clients
+        self.rows = rows_per_client
+        self.max_batch = max(max_batch, rows_per_client)
+        self.max_wait = max_wait_ms / 1000.0
+        self.board_x, self.board_y = nnet.board_x, nnet.board_y
+        self.action_size = nnet.action_size
+
+        in_size = num_clients * rows_per_client * self.board_x * self.board_y
+        out_size = num_clients * rows_per_client * (self.action_size + 1)
+        self.inputs = ctx.RawArray("f", in_size)
+        self.outputs = ctx.RawArray("f", out_size)
+        self.requests = ctx.Queue()
+        self.free_ids = ctx.Queue()
+        for i in range(num_clients):
+            self.free_ids.put(i)
+        self.ready = [ctx.Semaphore(0) for _ in range(num_clients)]
+
+        self.batch_sizes = Counter()  # rows per batch -> #batches
+        self.latencies = deque(maxlen=100000)  # seconds from submit to dispatch
+        self.thread = None
+
+    def client(self):
+        """Return a picklable InferenceClient to hand to a worker process"""
+        return InferenceClient(self)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _serve(self):
+        inputs = np.frombuffer(self.inputs, dtype=np.float32).reshape(
+            self.num_clients, self.rows, self.board_x, self.board_y
+        )
+        outputs = np.frombuffer(self.outputs, dtype=np.float32).reshape(
+            self.num_clients, self.rows, self.action_size + 1
+        )
+        carry = _NO_CARRY
+        while True:
+            first = carry if carry is not _NO_CARRY else self.requests.get()
+            carry = _NO_CARRY
+            if first is None:
+                return
+
+            batch = [first]
+            rows = first[1]
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None or rows + request[1] > self.max_batch:
+                    # serve it first thing in the next batch
+                    carry = request
+                    break
+                batch.append(request)
+                rows += request[1]
+
+            now = time.monotonic()
+            boards = np.concatenate([inputs[c, :k] for c, k, _ in batch])
+            pis, vs = self.nnet.predict_batch(boards)
+            start = 0
+            for c, k, submitted in batch:
+                outputs[c, :k, :-1] = pis[start : start + k]
+                outputs[c, :k, -1] = vs[start : start + k]
+                start += k
+                self.latencies.append(now - submitted)
+                self.ready[c].release()
+            self.batch_sizes[rows] += 1
+
+    def stats(self):
+        """Batch-size histogram and queue latency of the requests served so far"""
+        batches = sum(self.batch_sizes.values())
+        latencies = np.array(self.latencies) * 1000.0
+        return {
+            "batches": batches,
+            "mean_batch_size": sum(k * n for k, n in self.batch_sizes.items()) / max(batches, 1),
+            "batch_size_hist": dict(sorted(self.batch_sizes.items())),
+            "latency_ms_mean": float(latencies.mean()) if len(latencies) else 0.0,
+            "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "latency_ms_p95": float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+        }
+
+
+class InferenceClient:
+    """
+    Worker side of an InferenceServer with the predict and predict_batch
+    interface of NNetWrapper, so MCTS can use it as its nnet.
+
+    The client claims a free slot the first time it is used in a worker.
+    """
+
+    def __init__(self, server):
+        self.board_x, self.board_y = server.board_x, server.board_y
+        self.action_size = server.action_size
+        self.num_clients = server.num_clients
+        self.rows = server.rows
+        self._inputs = server.inputs
+        self._outputs = server.outputs
+        self.requests = server.requests
+        self.free_ids = server.free_ids
+        self.ready = server.ready
+        self.client_id = None
+
+    def _connect(self):
+        self.client_id = self.free_ids.get()
+        self.inputs = np.frombuffer(self._inputs, dtype=np.float32).reshape(
+            self.num_clients, self.rows, self.board_x, self.board_y
+        )[self.client_id]
+        self.outputs = np.frombuffer(self._outputs, dtype=np.float32).reshape(
+            self.num_clients, self.rows, self.action_size + 1
+        )[self.client_id]
+
+    def predict_batch(self, boards):
+        """
+        boards: list of np arrays with boards, at most rows_per_client
+
+        Returns:
+            pis: batch_size x action_size array of policies
+            vs: batch_size array of values
+        """
+        if self.client_id is None:
+            self._connect()
+        k = len(boards)
+        for i, board in enumerate(boards):
+            self.inputs[i] = np.asarray(board, dtype=np.float32)
+        self.requests.put((self.client_id, k, time.monotonic()))
+        self.ready[self.client_id].acquire()
+        return self.outputs[:k, :-1].copy(), self.outputs[:k, -1].copy()
+
+    def predict(self, board):
+        """
+        board: np array with board
+        """
+        pis, vs = self.predict_batch([board])
+        return pis[0], vs
+
+
+class EvalCache:
+    """
+    LRU cache of network evaluations keyed by the canonical symmetric form of
+    the board.
+
+    A board and its 7 rotations/reflections share one entry. The key is the
+    smallest of the 8 transformed boards, and the policy is stored in that
+    orientation, so a hit maps it back through the inverse transform of the
+    board that was looked up. The value is the same for all 8.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (policy in canonical orientation, value)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _transform(x, k):
+        x = np.rot90(x, k % 4)
+        return np.fliplr(x) if k >= 4 else x
+
+    @staticmethod
+    def _inverse(x, k):
+        if k >= 4:
+            x = np.fliplr(x)
+        return np.rot90(x, -(k % 4))
+
+    def key(self, board):
+        """Return (key, k) where transform k maps board to its canonical form"""
+        board = np.asarray(board, dtype=np.int8)
+        return min((self._transform(board, k).tobytes(), k) for k in range(8))
+
+    def get(self, key, k):
+        """Return (pi, v) for the board with this key and transform, or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        pi, v = entry
+        return self._inverse(pi, k).ravel(), v.copy()
+
+    def put(self, key, k, pi, v):
+        if key in self.entries:
+            return
+        n = int(round(len(pi) ** 0.5))
+        pi = np.ascontiguousarray(self._transform(np.reshape(pi, (n, n)), k))
+        v = np.array(v, copy=True)
+        self.entries[key] = (pi, v)
+        self.nbytes += len(key) + pi.nbytes + v.nbytes
+        while len(self.entries) > self.max_entries:
+            old_key, (old_pi, old_v) = self.entries.popitem(last=False)
+            self.nbytes -= len(old_key) + old_pi.nbytes + old_v.nbytes
+
+    def clear(self):
+        """Forget every entry and the hit counts, for when the network weights change"""
+        self.entries.clear()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zero the hit and miss counts, keeping the entries"""
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "nbytes": self.nbytes,
+        }
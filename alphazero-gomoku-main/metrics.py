@@ -0,0 +1,103 @@
+import contextlib
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Phase timings and counters of one SelfPlay.learn iteration.
+
+    phase(name) times a block and adds it to the iteration's total for
+    name, add() sums counters and peak() keeps maxima. emit() writes the
+    iteration as one JSON line to path, logs it to wandb if use_wandb, and
+    starts the next iteration from zero.
+    """
+
+    def __init__(self, path=None, use_wandb=False):
+        self.path = path
+        self.use_wandb = use_wandb
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.reset()
+
+    def reset(self):
+        self.phases = {}  # phase -> seconds
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak(self, name, value):
+        self.counters[name] = max(self.counters.get(name, value), value)
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def add_mcts(self, stats):
+        """Adds the MCTS.stats() of one search tree"""
+        for name, value in stats.items():
+            if name.startswith("mcts_max_"):
+                self.peak(name, value)
+            else:
+                self.add(name, value)
+
+    def emit(self, iteration):
+        record = {
+            "iteration": iteration,
+            "time": time.time(),
+            "phases": self.phases,
+            "counters": self.counters,
+        }
+        log.info(
+            "Iteration %d phases: %s",
+            iteration,
+            ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.phases.items()),
+        )
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if self.use_wandb:
+            import wandb
+
+            wandb.log(
+                {
+                    "iteration": iteration,
+                    **{f"time/{name}": seconds for name, seconds in self.phases.items()},
+                    **{f"metrics/{name}": value for name, value in self.counters.items()},
+                }
+            )
+        self.reset()
+
+
+class NullMetrics:
+    """Metrics that record nothing, for when they are switched off"""
+
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def add(self, name, value=1):
+        pass
+
+    def peak(self, name, value):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def add_mcts(self, stats):
+        pass
+
+    def emit(self, iteration):
+        pass
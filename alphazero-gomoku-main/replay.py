@@ -0,0 +1,271 @@
+import logging
+import os
+import queue
+import shutil
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+
+log = logging.getLogger(__name__)
+
+
+class ReplayBuffer:
+    """
+    Training examples of the latest iterations, stored in preallocated typed
+    arrays instead of lists of (board, pi, v) tuples:
+        boards: int8    capacity x n x n
+        pis:    float16 capacity x n*n (or float32)
+        vs:     float32 capacity
+
+    The arrays are a ring. Every iteration's examples are appended after the
+    previous ones, and once max_iters iterations are stored, starting a new
+    one drops the oldest. If the ring fills up, the oldest examples are
+    overwritten first.
+    """
+
+    def __init__(self, board_size, capacity, max_iters, pi_dtype=np.float16):
+        self.n = board_size
+        self.capacity = capacity
+        self.max_iters = max_iters
+        self.boards = np.zeros((capacity, board_size, board_size), dtype=np.int8)
+        self.pis = np.zeros((capacity, board_size * board_size), dtype=pi_dtype)
+        self.vs = np.zeros(capacity, dtype=np.float32)
+        self.start = 0  # slot of the oldest example
+        self.size = 0
+        self.iterations = deque()  # number of examples of each stored iteration, oldest first
+
+    @classmethod
+    def from_examples(cls, examples, pi_dtype=np.float32):
+        """Build a single-iteration buffer from a list of (board, pi, v)"""
+        buffer = cls(len(examples[0][0]), len(examples), 1, pi_dtype)
+        buffer.add_iteration(examples)
+        return buffer
+
+    def __len__(self):
+        return self.size
+
+    def nbytes_per_example(self):
+        return (self.boards.nbytes + self.pis.nbytes + self.vs.nbytes) // self.capacity
+
+    def _drop_oldest(self):
+        count = self.iterations.popleft()
+        self.start = (self.start + count) % self.capacity
+        self.size -= count
+
+    def start_iteration(self):
+        """Open a new iteration, dropping the oldest one if max_iters are stored"""
+        if len(self.iterations) >= self.max_iters:
+            self._drop_oldest()
+        self.iterations.append(0)
+
+    def append(self, board, pi, v):
+        """Add one example to the current iteration"""
+        if self.size == self.capacity:
+            # overwrite the oldest example
+            self.iterations[0] -= 1
+            if self.iterations[0] == 0:
+                self.iterations.popleft()
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+        i = (self.start + self.size) % self.capacity
+        self.boards[i] = board
+        self.pis[i] = pi
+        self.vs[i] = v
+        self.size += 1
+        self.iterations[-1] += 1
+
+    def add_iteration(self, examples):
+        """Start an iteration holding examples, a list of (board, pi, v)"""
+        self.start_iteration()
+        for board, pi, v in examples:
+            self.append(board, pi, v)
+
+    def sample(self, batch_size, rng=np.random):
+        """
+        Returns batch_size examples drawn uniformly with replacement as
+        (boards, pis, vs) arrays.
+        """
+        idx = (self.start + rng.randint(self.size, size=batch_size)) % self.capacity
+        return self.boards[idx], self.pis[idx], self.vs[idx]
+
+
+class DiskReplayBuffer:
+    """
+    Training examples of the latest iterations, stored on disk so that the
+    history survives restarts and can grow past RAM.
+
+    Every iteration is written once to its own directory under folder,
+    holding boards.npy (int8), pis.npy (float16, or float32) and vs.npy
+    (float32). The directory is renamed into place only after all three
+    files are written, so a crash never leaves a partial iteration behind. The files are opened with
+    mmap_mode="r": opening them on resume costs nothing, and sample() reads
+    only the rows it draws. Once max_iters iterations are stored, adding a
+    new one deletes the oldest.
+    """
+
+    def __init__(self, folder, board_size, max_iters, pi_dtype=np.float16):
+        self.folder = folder
+        self.n = board_size
+        self.max_iters = max_iters
+        self.pi_dtype = pi_dtype
+        self.files = deque()  # (name, boards, pis, vs) memmaps of each stored iteration, oldest first
+        self.iterations = deque()  # number of examples of each stored iteration, oldest first
+        self.next_id = 0
+
+        os.makedirs(folder, exist_ok=True)
+        names = []
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if name.endswith(".tmp"):
+                # left over from an interrupted write
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.isdigit() and os.path.isdir(path):
+                names.append(name)
+        if names:
+            self.next_id = int(names[-1]) + 1
+        for name in names[-max_iters:]:
+            self._open(name)
+        for name in names[:-max_iters]:
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+        if self.files:
+            log.info(f"Loaded {len(self)} examples of {len(self.files)} iterations from {folder}")
+
+    def __len__(self):
+        return sum(self.iterations)
+
+    def nbytes_per_example(self):
+        pis = np.dtype(self.pi_dtype).itemsize * self.n * self.n
+        return self.n * self.n + pis + np.dtype(np.float32).itemsize
+
+    def _open(self, name):
+        path = os.path.join(self.folder, name)
+        arrays = [np.load(os.path.join(path, f), mmap_mode="r") for f in ("boards.npy", "pis.npy", "vs.npy")]
+        self.files.append((name, *arrays))
+        self.iterations.append(len(arrays[2]))
+
+    def _drop_oldest(self):
+        name = self.files.popleft()[0]
+        self.iterations.popleft()
+        shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+
+    def add_iteration(self, examples):
+        """Write examples, a list of (board, pi, v), as a new iteration"""
+        if not examples:
+            return
+        name = f"{self.next_id:08d}"
+        self.next_id += 1
+        tmp = os.path.join(self.folder, name + ".tmp")
+        os.makedirs(tmp, exist_ok=True)
+        boards, pis, vs = zip(*examples)
+        np.save(os.path.join(tmp, "boards.npy"), np.array([np.asarray(b) for b in boards], dtype=np.int8))
+        np.save(os.path.join(tmp, "pis.npy"), np.array(pis, dtype=self.pi_dtype))
+        np.save(os.path.join(tmp, "vs.npy"), np.array(vs, dtype=np.float32))
+        os.rename(tmp, os.path.join(self.folder, name))
+
+        if len(self.files) >= self.max_iters:
+            self._drop_oldest()
+        self._open(name)
+
+    def sample(self, batch_size, rng=np.random):
+        """
+        Returns batch_size examples drawn uniformly with replacement as
+        (boards, pis, vs) arrays.
+        """
+        idx = rng.randint(len(self), size=batch_size)
+        offsets = np.cumsum([0] + list(self.iterations))
+        which = np.searchsorted(offsets, idx, side="right") - 1
+
+        boards = np.empty((batch_size, self.n, self.n), dtype=np.int8)
+        pis = np.empty((batch_size, self.n * self.n), dtype=self.files[0][2].dtype)
+        vs = np.empty(batch_size, dtype=np.float32)
+        for j in np.unique(which):
+            rows = np.flatnonzero(which == j)
+            local = idx[rows] - offsets[j]
+            _, b, p, v = self.files[j]
+            boards[rows] = b[local]
+            pis[rows] = p[local]
+            vs[rows] = v[local]
+        return boards, pis, vs
+
+
+class BatchPrefetcher:
+    """
+    Iterates over num_batches training batches of a replay buffer, assembled
+    on a background thread while the caller trains on the previous ones.
+
+    Batches are written into prefetch + 1 preallocated float32 tensor slots
+    (pinned if pin_memory, for asynchronous copies to the GPU) that are
+    reused for the whole run. A slot is handed back to the thread when the
+    caller asks for the next batch, so its tensors stay valid for the whole
+    training step. With prefetch=0 the batches are built on the calling
+    thread in a single slot.
+
+    transform(boards, pis, rng) is applied to every sampled batch, e.g.
+    GomokuGame.getBatchSymmetries.
+    """
+
+    def __init__(self, examples, batch_size, num_batches, transform=None, prefetch=2, pin_memory=False, seed=None):
+        self.examples = examples
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.transform = transform
+        self.prefetch = prefetch
+        # the thread draws from its own generator, seeded from the global one by default
+        self.rng = np.random.RandomState(np.random.randint(2**31) if seed is None else seed)
+
+        n = examples.n
+        self.slots = []
+        for _ in range(prefetch + 1):
+            tensors = (
+                torch.empty((batch_size, n, n), dtype=torch.float32, pin_memory=pin_memory),
+                torch.empty((batch_size, n * n), dtype=torch.float32, pin_memory=pin_memory),
+                torch.empty(batch_size, dtype=torch.float32, pin_memory=pin_memory),
+            )
+            self.slots.append(tensors)
+
+    def __len__(self):
+        return self.num_batches
+
+    def _fill(self, slot):
+        boards, pis, vs = self.examples.sample(self.batch_size, self.rng)
+        if self.transform is not None:
+            boards, pis = self.transform(boards, pis, self.rng)
+        for tensor, array in zip(self.slots[slot], (boards, pis, vs)):
+            np.copyto(tensor.numpy(), array)
+
+    def _produce(self, free, ready):
+        try:
+            for _ in range(self.num_batches):
+                slot = free.get()
+                if slot is None:
+                    return
+                self._fill(slot)
+                ready.put(slot)
+        except Exception as e:
+            ready.put(e)
+
+    def __iter__(self):
+        if self.prefetch == 0:
+            for _ in range(self.num_batches):
+                self._fill(0)
+                yield self.slots[0]
+            return
+
+        free, ready = queue.Queue(), queue.Queue()
+        for slot in range(len(self.slots)):
+            free.put(slot)
+        thread = threading.Thread(target=self._produce, args=(free, ready), daemon=True)
+        thread.start()
+        try:
+            for _ in range(self.num_batches):
+                slot = ready.get()
+                if isinstance(slot, Exception):
+                    raise slot
+                yield self.slots[slot]
+                free.put(slot)
+        finally:
+            # stops the thread if the loop is left early
+            free.put(None)
+            thread.join()